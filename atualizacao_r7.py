@@ -1,13 +1,42 @@
+import io
+import getpass
+import socket
+import argparse
+import asyncio
 import os
+import csv
+import hashlib
+import json
+import sqlite3
+import re
+import shutil
+import tempfile
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+import numpy as np
 import pandas as pd
 import time
+import itertools
+import warnings
 from openpyxl import load_workbook, Workbook
-from openpyxl.utils import get_column_letter
-from openpyxl.worksheet.table import Table, TableStyleInfo
+from openpyxl.utils import get_column_letter, column_index_from_string
+from openpyxl.worksheet.table import Table, TableColumn, TableStyleInfo
 from datetime import datetime
+from collections import deque, namedtuple
+from contextlib import contextmanager, nullcontext
+from xml.sax.saxutils import escape
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:  # Só a saída colunar (SAIDA_COLUNAR) precisa do pyarrow
+    pa = None
 import tkinter as tk
 from tkinter import ttk
-from threading import Thread
+from threading import Thread, Lock, Event
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 
 # Diretórios fixos
 DIRETORIOS_ORIGEM = [
@@ -16,28 +45,274 @@ DIRETORIOS_ORIGEM = [
 ]
 DIRETORIO_DESTINO = r"Y:\BR10\IndustrialEngineering\Documents\KPI\python BI\base de dados"
 ARQUIVO_DESTINO = "base_de_dados.xlsx"
+# Caminho de extração usado por extrair_dados: "blocos", "vetorizado" ou "linear"
+MODO_EXTRACAO = "blocos"
+# Lê os CSV linha a linha, sem montar DataFrame (processar_csv_streaming/extrair_dados_streaming)
+LEITURA_STREAMING = False
+# Registro local (SQLite) dos arquivos já processados, consultado antes de abrir arquivo ou planilha
+DIRETORIO_LOCAL = os.path.dirname(os.path.abspath(__file__))
+ARQUIVO_REGISTRO = os.path.join(DIRETORIO_LOCAL, "registro_arquivos.sqlite")
+# Cópia local dos CSV da rede, lida no lugar do compartilhamento (que nunca é escrito)
+USAR_CACHE_LOCAL = True
+DIRETORIO_CACHE = os.path.join(DIRETORIO_LOCAL, "cache_origem")
+LIMITE_CACHE_BYTES = 2 * 1024 * 1024 * 1024  # Acima disso saem os arquivos usados há mais tempo
+MODO_OFFLINE = False  # True roda só com o que está no cache, sem acessar os diretórios de origem
+# Diário local das linhas extraídas, gravado a cada CHECKPOINT_ARQUIVOS arquivos, para retomar
+# uma execução interrompida (--retomar) sem extrair de novo os arquivos já concluídos
+DIARIO_EXTRACAO = os.path.join(DIRETORIO_LOCAL, "diario_extracao.jsonl")
+CHECKPOINT_ARQUIVOS = 20
+RETOMAR_EXECUCAO = False
+VERIFICAR_GRAVACAO = True  # Relê a planilha salva antes de apagar o diário
+# Onde as linhas extraídas são gravadas: "planilha" (base_de_dados.xlsx) ou "sqlite" (BANCO_DADOS é o
+# registro oficial e a planilha só é gerada com --exportar ou a cada INTERVALO_EXPORTACAO no modo --observar)
+BACKEND_ARMAZENAMENTO = "planilha"
+BANCO_DADOS = os.path.join(DIRETORIO_LOCAL, "base_de_dados.sqlite")
+INTERVALO_EXPORTACAO = 3600  # segundos
+# Saída colunar para o BI: cada gravação acrescenta arquivos Parquet (ou Feather) particionados
+# por mês de criação em DIRETORIO_COLUNAR/<aba>/mes=AAAA-MM/, sem reescrever os já existentes
+SAIDA_COLUNAR = False
+FORMATO_COLUNAR = "parquet"  # "parquet" ou "feather"
+DIRETORIO_COLUNAR = os.path.join(DIRETORIO_DESTINO, "colunar")
+# Trava (arquivo .lock ao lado da planilha) para execuções simultâneas gravarem uma de cada vez
+TRAVA_PLANILHA = True
+ESPERA_TRAVA = 300  # segundos máximos esperando outra execução terminar de gravar
+TEMPO_LIMITE_TRAVA = 900  # trava mais antiga que isso é de uma execução que caiu e é removida
+RENOVACAO_TRAVA = 60  # segundos entre renovações da data da trava enquanto ela está em uso
+TENTATIVAS_GRAVACAO = 3  # ex.: planilha aberta no Excel no momento da troca
+# Modo observação (--observar): varredura periódica dos diretórios de origem em lotes pequenos
+INTERVALO_OBSERVACAO = 30  # segundos entre varreduras
+ESPERA_ESTABILIDADE = 10  # segundos sem mudar tamanho/data antes de um arquivo ser lido
+TAMANHO_LOTE = 50  # arquivos por gravação na planilha
+# Relatório da conferência arquivos x planilha (listar_arquivos_e_verificar), no lugar do logPFRO.log
+RELATORIO_CONFERENCIA = os.path.join(DIRETORIO_LOCAL, "conferencia_arquivos.csv")
+USAR_REGISTRO = True
+# Acrescenta as linhas direto no XML das abas (anexar_em_excel) em vez de regravar a planilha inteira
+ESCRITA_INCREMENTAL = True
+# Extração dos arquivos em processos separados; None usa um processo por núcleo
+EXTRACAO_PARALELA = True
+PROCESSOS_EXTRACAO = None
+# Abaixo disso a extração fica no processo principal: cada processo novo reimporta pandas/numpy/openpyxl
+MINIMO_ARQUIVOS_PARALELO = 4
+# Leitura antecipada dos arquivos da rede em threads, limitada pelo total de bytes em memória
+LEITORES_PREFETCH = 8
+LIMITE_PREFETCH_BYTES = 64 * 1024 * 1024
+# Executa as etapas como um pipeline asyncio com filas limitadas (executar_pipeline_async)
+ORQUESTRACAO_ASYNC = False
+# Lista os diretórios de origem em paralelo (descobrir_arquivos)
+LISTAGEM_PARALELA = True
+# Guarda no registro um retrato de cada diretório de origem e só relista os que mudaram
+USAR_SNAPSHOT = True
+VARREDURA_COMPLETA = False  # True força relistar todos os diretórios, ignorando o retrato
+# Descarta sem abrir os arquivos cujo número no nome já está na planilha (interpretar_nome_arquivo).
+# Só vale se o número do nome for o mesmo gravado na coluna A.
+CLASSIFICAR_PELO_NOME = False
+# Descarta arquivos com o mesmo conteúdo de outro já visto (cópias e reenvios), sem extrair
+USAR_DEDUPLICACAO = True
+TAMANHO_FILAS = 16
+
+# Arquivo de origem com os metadados obtidos na listagem do diretório
+ArquivoOrigem = namedtuple("ArquivoOrigem", ["caminho", "nome", "tamanho", "mtime", "ctime"])
+
+def listar_diretorio(diretorio, extensao=".csv"):
+    """
+    Lista um diretório com os.scandir e guarda tamanho e datas do próprio DirEntry.
+    Com extensao=None entram todos os arquivos.
+    """
+    arquivos = []
+    try:
+        with os.scandir(diretorio) as entradas:
+            for entrada in entradas:
+                if (extensao is None or entrada.name.endswith(extensao)) and entrada.is_file():
+                    info = entrada.stat()
+                    arquivos.append(ArquivoOrigem(entrada.path, entrada.name, info.st_size,
+                                                  info.st_mtime, info.st_ctime))
+    except Exception as e:
+        print(f"Erro ao acessar o diretório {diretorio}: {e}")
+    return arquivos
+
+def descobrir_arquivos(diretorios, extensao=".csv"):
+    """
+    Lista os diretórios ao mesmo tempo, um por thread, para que a latência da rede de cada
+    pasta não se some. O resultado segue a ordem de diretorios, e as etapas seguintes reusam
+    tamanho e datas de ArquivoOrigem sem consultar o arquivo de novo.
+    """
+    if len(diretorios) <= 1 or not LISTAGEM_PARALELA:
+        return [arquivo for diretorio in diretorios for arquivo in listar_diretorio(diretorio, extensao)]
+    with ThreadPoolExecutor(max_workers=len(diretorios)) as executor:
+        listagens = list(executor.map(lambda diretorio: listar_diretorio(diretorio, extensao), diretorios))
+    return [arquivo for listagem in listagens for arquivo in listagem]
 
 def listar_arquivos(diretorios, extensao=".csv"):
     """Lista arquivos com a extensão especificada em múltiplos diretórios."""
-    arquivos = []
-    for diretorio in diretorios:
+    return [arquivo.caminho for arquivo in descobrir_arquivos(diretorios, extensao)]
+
+def ler_arquivo(caminho_arquivo):
+    """
+    Lê o arquivo inteiro de uma vez. O mesmo conteúdo serve para a primeira célula e para o parse.
+    """
+    with open(caminho_arquivo, "rb") as f:
+        return f.read()
+
+CacheLocal = namedtuple("CacheLocal", ["diretorio", "conexao", "trava", "limite_bytes"])
+
+def abrir_cache(diretorio, limite_bytes=None):
+    """
+    Abre (ou cria) o cache local dos arquivos de origem. O índice SQLite fica no próprio diretório
+    e é compartilhado entre as threads de leitura com uma trava.
+    """
+    os.makedirs(diretorio, exist_ok=True)
+    conexao = sqlite3.connect(os.path.join(diretorio, "indice.sqlite"), check_same_thread=False)
+    conexao.execute("""
+        CREATE TABLE IF NOT EXISTS arquivos_cache (
+            chave TEXT PRIMARY KEY,
+            caminho TEXT,
+            nome TEXT,
+            tamanho INTEGER,
+            mtime REAL,
+            ctime REAL,
+            ultimo_uso REAL
+        )
+    """)
+    conexao.execute("CREATE INDEX IF NOT EXISTS idx_cache_caminho ON arquivos_cache (caminho)")
+    conexao.commit()
+    return CacheLocal(diretorio, conexao, Lock(), limite_bytes or LIMITE_CACHE_BYTES)
+
+def chave_cache(arquivo):
+    """
+    Chave do arquivo no cache: caminho remoto + tamanho + data de modificação da listagem.
+    Um arquivo alterado na origem ganha outra chave, sem precisar comparar conteúdo.
+    """
+    return hashlib.sha1(f"{arquivo.caminho}|{arquivo.tamanho}|{arquivo.mtime}".encode("utf-8")).hexdigest()
+
+def ler_arquivo_cache(cache, arquivo):
+    """
+    Lê o arquivo pelo cache local; na falta, lê da origem (só leitura) e guarda a cópia.
+    Em MODO_OFFLINE um arquivo fora do cache gera FileNotFoundError.
+    """
+    chave = chave_cache(arquivo)
+    local = os.path.join(cache.diretorio, chave + ".csv")
+    with cache.trava:
+        em_cache = cache.conexao.execute("SELECT 1 FROM arquivos_cache WHERE chave = ?", (chave,)).fetchone()
+    if em_cache:
         try:
-            arquivos += [os.path.join(diretorio, f) for f in os.listdir(diretorio) if f.endswith(extensao)]
-        except Exception as e:
-            print(f"Erro ao acessar o diretório {diretorio}: {e}")
-    return arquivos
+            with open(local, "rb") as f:
+                conteudo = f.read()
+            if len(conteudo) == arquivo.tamanho:
+                with cache.trava:
+                    cache.conexao.execute("UPDATE arquivos_cache SET ultimo_uso = ? WHERE chave = ?", (time.time(), chave))
+                    cache.conexao.commit()
+                return conteudo
+        except OSError:
+            pass  # Cópia local removida ou incompleta: lê da origem de novo
+    if MODO_OFFLINE:
+        raise FileNotFoundError(f"Arquivo fora do cache local (modo offline): {arquivo.caminho}")
+    conteudo = ler_arquivo(arquivo.caminho)
+    if len(conteudo) != arquivo.tamanho:
+        return conteudo  # Mudou desde a listagem; a próxima execução guarda a versão nova
+    descritor, temporario = tempfile.mkstemp(dir=cache.diretorio, suffix=".tmp")
+    with os.fdopen(descritor, "wb") as f:
+        f.write(conteudo)
+    os.replace(temporario, local)
+    with cache.trava:
+        antigas = cache.conexao.execute(
+            "SELECT chave FROM arquivos_cache WHERE caminho = ? AND chave != ?", (arquivo.caminho, chave)).fetchall()
+        remover_do_cache(cache, [antiga for antiga, in antigas])
+        cache.conexao.execute("INSERT OR REPLACE INTO arquivos_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (chave, arquivo.caminho, arquivo.nome, arquivo.tamanho, arquivo.mtime,
+                               arquivo.ctime, time.time()))
+        despejar_cache(cache)
+        cache.conexao.commit()
+    return conteudo
+
+def remover_do_cache(cache, chaves):
+    """Apaga do cache as cópias locais e as linhas do índice das chaves informadas."""
+    for chave in chaves:
+        try:
+            os.remove(os.path.join(cache.diretorio, chave + ".csv"))
+        except FileNotFoundError:
+            pass
+    cache.conexao.executemany("DELETE FROM arquivos_cache WHERE chave = ?", [(chave,) for chave in chaves])
 
-def processar_csv(caminho_arquivo):
+def despejar_cache(cache):
+    """
+    Mantém o cache dentro de limite_bytes removendo os arquivos usados há mais tempo (LRU).
+    Chamado com a trava do cache já obtida.
+    """
+    total = 0
+    excedentes = []
+    for chave, tamanho in cache.conexao.execute("SELECT chave, tamanho FROM arquivos_cache ORDER BY ultimo_uso DESC"):
+        total += tamanho
+        if total > cache.limite_bytes:
+            excedentes.append(chave)
+    remover_do_cache(cache, excedentes)
+
+def arquivos_em_cache(cache, diretorios, extensao=".csv"):
+    """
+    Listagem do modo offline: os arquivos dos diretórios de origem que têm cópia no cache,
+    com tamanho e datas guardados da última listagem da rede.
+    """
+    diretorios = {os.path.normcase(os.path.normpath(diretorio)) for diretorio in diretorios}
+    with cache.trava:
+        linhas = cache.conexao.execute(
+            "SELECT caminho, nome, tamanho, mtime, ctime FROM arquivos_cache ORDER BY caminho").fetchall()
+    return [ArquivoOrigem(*linha) for linha in linhas
+            if linha[1].endswith(extensao)
+            and os.path.normcase(os.path.normpath(os.path.dirname(linha[0]))) in diretorios]
+
+def ler_origem(arquivo, cache=None):
+    """Lê o conteúdo de um ArquivoOrigem, pelo cache local quando houver um."""
+    if cache is not None:
+        return ler_arquivo_cache(cache, arquivo)
+    return ler_arquivo(arquivo.caminho)
+
+def pre_carregar_arquivos(arquivos, leitores=None, limite_bytes=None, cache=None):
+    """
+    Lê os arquivos em threads, à frente de quem consome, e os entrega na ordem da lista como
+    (arquivo, conteúdo, erro). As leituras em andamento somam no máximo limite_bytes (pelo tamanho
+    da listagem; um arquivo maior que o limite passa sozinho), então um consumo lento segura as leituras.
+    """
+    leitores = leitores or LEITORES_PREFETCH
+    limite_bytes = limite_bytes or LIMITE_PREFETCH_BYTES
+    arquivos = iter(arquivos)
+    fila = deque()
+    em_memoria = 0
+    with ThreadPoolExecutor(max_workers=leitores) as executor:
+        proximo = next(arquivos, None)
+        while proximo is not None or fila:
+            while proximo is not None and (not fila or em_memoria + proximo.tamanho <= limite_bytes):
+                fila.append((proximo, executor.submit(ler_origem, proximo, cache)))
+                em_memoria += proximo.tamanho
+                proximo = next(arquivos, None)
+            arquivo, futuro = fila.popleft()
+            try:
+                conteudo, erro = futuro.result(), None
+            except Exception as e:
+                conteudo, erro = None, e
+            em_memoria -= arquivo.tamanho
+            yield arquivo, conteudo, erro
+
+def ler_primeira_celula(conteudo):
+    """
+    Retorna a primeira célula da primeira linha do conteúdo do .csv.
+    """
+    primeira_linha = conteudo.split(b"\n", 1)[0].decode("latin1")
+    return primeira_linha.split(";")[0].strip()
+
+def processar_csv(caminho_arquivo, conteudo=None, ctime=None):
     """
     Processa o arquivo .csv para verificar a primeira célula e determinar a aba correta.
     Retorna o tipo (Sales Orders ou Quotations), DataFrame do CSV, o número extraído e a data de criação.
+    Se o conteúdo e a data de criação já foram obtidos (ler_arquivo/descobrir_arquivos), o arquivo não é reaberto.
     """
     try:
-        df = pd.read_csv(caminho_arquivo, header=None, delimiter=";", encoding='latin1')
+        origem = io.BytesIO(conteudo) if conteudo is not None else caminho_arquivo
+        df = pd.read_csv(origem, header=None, delimiter=";", encoding='latin1')
         primeira_celula = str(df.iloc[0, 0]).strip()
         if primeira_celula.startswith('5') or primeira_celula.startswith('2'):
             numero = primeira_celula.strip()
-            data_criacao = datetime.fromtimestamp(os.path.getctime(caminho_arquivo)).strftime("%d/%m/%Y")
+            if ctime is None:
+                ctime = os.path.getctime(caminho_arquivo)
+            data_criacao = datetime.fromtimestamp(ctime).strftime("%d/%m/%Y")
             return ('Sales Orders' if numero.startswith('5') else 'Quotations'), df, numero, data_criacao, None
         else:
             return None, None, None, None, None
@@ -45,6 +320,101 @@ def processar_csv(caminho_arquivo):
         print(f"Erro ao processar o arquivo {caminho_arquivo}: {e}")
         return None, None, None, None, None
 
+# Textos que o pandas lê como vazio (NaN) por padrão
+VALORES_VAZIOS = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                  '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'}
+
+def tipo_celula_csv(celula):
+    """
+    Tipo que a célula dá à coluna na inferência do pandas: 'vazio', 'inteiro', 'decimal' ou 'texto'.
+    """
+    if celula in VALORES_VAZIOS:
+        return "vazio"
+    if "_" in celula:
+        return "texto"  # float() do Python aceita '1_000', o pandas não
+    try:
+        int(celula)
+        return "inteiro"
+    except ValueError:
+        pass
+    try:
+        float(celula)
+        return "decimal"
+    except ValueError:
+        return "texto"
+
+def ler_csv_streaming(caminho_arquivo, conteudo=None):
+    """
+    Gera as linhas do .csv uma a uma, com as células como o pandas as lê. Uma primeira passada só
+    infere o tipo de cada coluna (inteiro sem vazios, decimal, ou texto se houver algum valor não
+    numérico); a segunda converte as células: número nas colunas numéricas, texto nas demais e NaN
+    para vazio. As linhas são completadas até a largura da primeira, como no DataFrame.
+    """
+    def abrir():
+        if conteudo is not None:
+            return io.TextIOWrapper(io.BytesIO(conteudo), encoding="latin1", newline="")
+        return open(caminho_arquivo, "r", encoding="latin1", newline="")
+
+    tipos = []
+    menor_largura = None
+    with abrir() as f:
+        for linha in csv.reader(f, delimiter=";"):
+            if not linha:
+                continue
+            menor_largura = len(linha) if menor_largura is None else min(menor_largura, len(linha))
+            for col, celula in enumerate(linha):
+                if col == len(tipos):
+                    tipos.append(set())
+                if "texto" not in tipos[col]:
+                    tipos[col].add(tipo_celula_csv(celula))
+    conversoes = []
+    for col, tipos_coluna in enumerate(tipos):
+        if "texto" in tipos_coluna:
+            conversoes.append(None)
+        elif "decimal" in tipos_coluna or "vazio" in tipos_coluna or col >= menor_largura:
+            # Vazio (ou linha mais curta, completada com NaN) impede a coluna de ser inteira
+            conversoes.append(float)
+        else:
+            conversoes.append(int)
+    with abrir() as f:
+        largura = None
+        for linha in csv.reader(f, delimiter=";"):
+            if not linha:
+                continue
+            linha = [float("nan") if celula in VALORES_VAZIOS
+                     else celula if conversoes[col] is None else conversoes[col](celula)
+                     for col, celula in enumerate(linha)]
+            if largura is None:
+                largura = len(linha)
+            elif len(linha) < largura:
+                linha += [float("nan")] * (largura - len(linha))
+            yield linha
+
+def processar_csv_streaming(caminho_arquivo, conteudo=None, ctime=None):
+    """
+    Equivalente a processar_csv sem DataFrame: lê só a primeira linha para decidir a aba e devolve,
+    no lugar do DataFrame, o gerador das linhas do arquivo (incluindo a primeira).
+    """
+    try:
+        linhas = ler_csv_streaming(caminho_arquivo, conteudo)
+        primeira_linha = next(linhas, None)
+        if not primeira_linha:
+            return None, None, None, None, None
+        # Com a coluna 0 numérica (e vazia nas demais linhas) o número vem como float ('5753532.0'), como no DataFrame
+        primeira_celula = str(primeira_linha[0]).strip()
+        if primeira_celula.startswith('5') or primeira_celula.startswith('2'):
+            numero = primeira_celula
+            if ctime is None:
+                ctime = os.path.getctime(caminho_arquivo)
+            data_criacao = datetime.fromtimestamp(ctime).strftime("%d/%m/%Y")
+            tipo = 'Sales Orders' if numero.startswith('5') else 'Quotations'
+            return tipo, itertools.chain([primeira_linha], linhas), numero, data_criacao, None
+        linhas.close()
+        return None, None, None, None, None
+    except Exception as e:
+        print(f"Erro ao processar o arquivo {caminho_arquivo}: {e}")
+        return None, None, None, None, None
+
 def extrair_cliente(nome_arquivo):
     """
     Extrai o nome do cliente a partir do nome do arquivo.
@@ -56,10 +426,429 @@ def extrair_cliente(nome_arquivo):
     except IndexError:
         return "Cliente Desconhecido"
 
-def extrair_dados(df, tipo, numero, data_criacao, customer):
+# Nome dos uploads: "Solicitante____numero____BoQ_Grouped_ddmmaaaa hhmmss____dd.mm.aaaa_hhmmss[ - Copy].csv"
+PADRAO_NOME_ARQUIVO = re.compile(
+    r"^(?P<solicitante>.*?)____(?P<numero>\d+)____(?P<descricao>.*?)____"
+    r"(?P<data_upload>\d{2}\.\d{2}\.\d{4}_\d{6})(?P<sufixo>.*?)\.csv$", re.IGNORECASE)
+PADRAO_DATA_BOQ = re.compile(r"(\d{8} \d{6})$")
+NomeArquivo = namedtuple("NomeArquivo", ["solicitante", "numero", "descricao", "data_boq", "data_upload", "sufixo"])
+
+def interpretar_nome_arquivo(nome_arquivo):
+    """
+    Separa o nome de um upload de BoQ em campos. As datas viram datetime (None se a descrição
+    não tiver a data do BoQ). Retorna None para nomes fora do padrão.
+    """
+    encontrado = PADRAO_NOME_ARQUIVO.match(nome_arquivo)
+    if encontrado is None:
+        return None
+    data_boq = PADRAO_DATA_BOQ.search(encontrado["descricao"])
+    try:
+        return NomeArquivo(
+            encontrado["solicitante"].strip(),
+            encontrado["numero"],
+            encontrado["descricao"],
+            datetime.strptime(data_boq.group(1), "%d%m%Y %H%M%S") if data_boq else None,
+            datetime.strptime(encontrado["data_upload"], "%d.%m.%Y_%H%M%S"),
+            encontrado["sufixo"].strip(),
+        )
+    except ValueError:
+        return None
+
+def prioridade_original(arquivo):
+    """
+    Chave de ordenação dos arquivos: entre cópias do mesmo conteúdo ou reenvios do mesmo número,
+    o original é o primeiro nesta ordem, o nome sem sufixo (" - Copy") e depois o upload mais antigo.
+    Nomes fora do padrão vêm por último, na ordem da listagem.
+    """
+    campos = interpretar_nome_arquivo(arquivo.nome)
+    if campos is None:
+        return True, True, datetime.max
+    return False, bool(campos.sufixo), campos.data_upload
+
+def indexar_nomes_arquivos(arquivos):
+    """
+    Monta {número do documento: [ArquivoOrigem, ...]} a partir dos nomes, sem abrir os arquivos.
+    Cópias (" - Copy") do mesmo documento ficam na mesma lista. Nomes fora do padrão ficam em None.
+    """
+    indice = {}
+    for arquivo in arquivos:
+        campos = interpretar_nome_arquivo(arquivo.nome)
+        indice.setdefault(campos.numero if campos else None, []).append(arquivo)
+    return indice
+
+def classificar_pelo_nome(arquivos, sales_numbers, quotations_numbers):
+    """
+    Classifica os arquivos só pelo número do nome, sem abri-los. Pelo índice de indexar_nomes_arquivos
+    cada número é procurado uma vez para todos os arquivos dele (cópias e reenvios).
+    Retorna {caminho: (número, aba, situação 'existente' ou 'novo')}; nomes fora do padrão ficam de fora.
+    """
+    classificacao = {}
+    for numero, arquivos_numero in indexar_nomes_arquivos(arquivos).items():
+        if numero is None:
+            continue
+        if numero.startswith('5'):
+            tipo_arquivo, numeros = 'Sales Orders', sales_numbers
+        elif numero.startswith('2'):
+            tipo_arquivo, numeros = 'Quotations', quotations_numbers
+        else:
+            continue
+        situacao = "existente" if canonizar_numero(numero) in numeros else "novo"
+        for arquivo in arquivos_numero:
+            classificacao[arquivo.caminho] = (numero, tipo_arquivo, situacao)
+    return classificacao
+
+# Esquema das colunas das abas. Fonte: chave AT_MCP2_* (valor na coluna seguinte do CSV),
+# índice da coluna na linha 'AT-' ou nome de um dado do arquivo (numero, data_criacao, customer).
+# colunar é o tipo da coluna na saída colunar: 'texto', 'inteiro', 'decimal' ou 'data'
+Coluna = namedtuple("Coluna", ["nome", "nome_quotations", "fonte", "tipo", "padrao", "na", "colunar"],
+                    defaults=("texto",))
+ESQUEMA = [
+    Coluna("Sales Order", "Quotation", "numero", "valor", None, None),
+    Coluna("Module", None, 2, "codigo", None, None),
+    Coluna("Quantity", None, 3, "inteiro", None, None, "inteiro"),
+    Coluna("Length", "Module Length", "AT_MCP2_MOD_LEN_M", "comprimento", 0, None, "inteiro"),
+    Coluna("Between Frames", None, "AT_MCP2_BTF_LEN_M", "texto", 0, "None", "decimal"),
+    Coluna("Pitch", None, "AT_MCP2_PIT_M", "texto", 0, "None", "decimal"),
+    Coluna("Gear Ratio", None, "AT_MCP2_GEA_01_RAT", "texto", 0, "None"),
+    Coluna("Power (W)", None, "AT_MCP2_RD_POW_M", "texto", 0, "None", "decimal"),
+    Coluna("Voltage (V)", None, "AT_MCP2_RD_VOT", "texto", 0, "None", "decimal"),
+    Coluna("Interface Type", None, "AT_MCP2_RD_INT_TYP", "texto", 0, "None"),
+    Coluna("Sensor Type", None, "AT_MCP2_SEN_SPLR_01", "texto", 0, "None"),
+    Coluna("TOR", None, "AT_MCP2_TOP_LVL_CNV_HEI_M", "texto", 0, "None", "decimal"),
+    Coluna("Control Card", None, "AT_MCP2_CTR_CRD_TYP", "texto", 0, "None"),
+    Coluna("Zone Length", None, "AT_MCP2_ZON_LEN_M", "texto", 0, "None", "decimal"),
+    Coluna("Eletric Side", None, "AT_MCP2_ELC_SID", "texto", 0, "None"),
+    Coluna("Side Guide Left Type", None, "AT_MCP2_SGD_LFT_TYP", "texto", 0, "None"),
+    Coluna("Side Guide Right Type", None, "AT_MCP2_SGD_RGT_TYP", "texto", 0, "None"),
+    Coluna("Bus Type", None, "AT_MCP2_CTR_BUS_TYP", "texto", 0, "None"),
+    Coluna("MSC Quantity", None, "AT_MCP2_ROL_MSC_01_QTY", "texto", 0, "None", "inteiro"),
+    Coluna("Merge/Divert", None, "AT_MCP2_MRG_DIV_SEL", "texto", 0, "None"),
+    Coluna("Merge/Divert Angle", None, "AT_MCP2_MOD_MRG_ANG", "texto", 0, "None", "decimal"),
+    Coluna("Alignment Angle", None, "AT_MCP2_FKT_ANG", "texto", 0, "None", "decimal"),
+    Coluna("Motor Position", None, "AT_MCP2_DRV_UNT_POS", "texto", 0, "None"),
+    Coluna("Motor Manufacturer", None, "AT_MCP2_MOT_MNF", "texto", 0, "None"),
+    Coluna("Framebed Type", None, "AT_MCP2_FRB_TYP", "texto", 0, "None"),
+    Coluna("Sword Quantity", None, "AT_MCP2_TRF_SWO_QTY", "texto", 0, "None", "inteiro"),
+    Coluna("Cassetes Quantity", None, "AT_MCP2_CAS_QTY", "texto", 0, "None", "inteiro"),
+    Coluna("Lower Conveyor Height (TOR1)", None, "AT_MCP2_LOW_LVL_CNV_HEI_M", "texto", 0, "None", "decimal"),
+    Coluna("Higher Conveyor Height (TOR21)", None, "AT_MCP2_TOP_LVL_CNV_HEI_M", "texto", 0, "None", "decimal"),
+    Coluna("Support Type", None, "AT_MCP2_SP_TYP_01", "texto", 0, "None"),
+    Coluna("Creation Date", None, "data_criacao", "valor", None, None, "data"),
+    Coluna("Delivery Date", None, 8, "data", "", None, "data"),
+    Coluna("Customer", None, "customer", "valor", None, None),
+]
+CHAVE_COMPRIMENTO = "AT_MCP2_MOD_LEN_M"
+CHAVE_ANGULO = "AT_MCP2_FKT_ANG"
+PREFIXO_CHAVES = "AT_MCP2_"
+CODIGO_CURVA = "AT-RM8320-E2"
+COMPRIMENTO_CURVA = {30: 542, 45: 813, 60: 1084, 90: 1626}
+
+def converter_texto(coluna, valor, contexto):
+    if valor == "NA":
+        return coluna.na
+    return str(valor).strip() if valor else coluna.padrao
+
+def converter_inteiro(coluna, valor, contexto):
+    return int(valor) if str(valor).isdigit() else coluna.padrao
+
+def converter_comprimento(coluna, valor, contexto):
+    """
+    Comprimento do módulo. Para 'AT-RM8320-E2' usa o ângulo da curva, quando encontrado.
+    """
+    if contexto["codigo"] == CODIGO_CURVA and contexto["angulo"] is not None:
+        return COMPRIMENTO_CURVA.get(contexto["angulo"], 0)
+    return int(float(valor)) if str(valor).replace('.', '', 1).isdigit() else coluna.padrao
+
+def converter_data(coluna, valor, contexto):
+    data = str(valor).strip()
+    return data.replace('.', '/') if data else data
+
+CONVERSORES = {
+    "valor": lambda coluna, valor, contexto: valor,
+    "codigo": lambda coluna, valor, contexto: str(valor).strip(),
+    "texto": converter_texto,
+    "inteiro": converter_inteiro,
+    "comprimento": converter_comprimento,
+    "data": converter_data,
+}
+
+EsquemaCompilado = namedtuple("EsquemaCompilado", ["cabecalhos", "chaves", "montar"])
+
+def compilar_esquema(esquema):
+    """
+    Gera a partir do esquema os cabeçalhos de cada aba, a lista de chaves distintas a buscar
+    (cada chave é resolvida uma só vez, mesmo se usada em mais de uma coluna) e a função que
+    monta a linha da planilha a partir do mapa de chaves, da linha 'AT-' e do contexto do arquivo.
+    """
+    cabecalhos = {
+        "Sales Orders": [coluna.nome for coluna in esquema],
+        "Quotations": [coluna.nome_quotations or coluna.nome for coluna in esquema],
+    }
+    chaves = list(dict.fromkeys(coluna.fonte for coluna in esquema
+                                if isinstance(coluna.fonte, str) and coluna.fonte.startswith(PREFIXO_CHAVES)))
+    passos = []
+    for coluna in esquema:
+        conversor = CONVERSORES[coluna.tipo]
+        if isinstance(coluna.fonte, int):
+            origem = "linha"
+        elif coluna.fonte in chaves:
+            origem = "chave"
+        else:
+            origem = "contexto"
+        passos.append((origem, coluna.fonte, coluna, conversor))
+
+    def montar(mapa, linha, contexto):
+        item = []
+        for origem, fonte, coluna, conversor in passos:
+            if origem == "chave":
+                valor = mapa.get(fonte)  # Chave não encontrada cai no padrão da coluna
+            elif origem == "linha":
+                if fonte >= len(linha):
+                    item.append(coluna.padrao)
+                    continue
+                valor = linha[fonte]
+            else:
+                valor = contexto[fonte]
+            item.append(conversor(coluna, valor, contexto))
+        return item
+
+    return EsquemaCompilado(cabecalhos, chaves, montar)
+
+ESQUEMA_COMPILADO = compilar_esquema(ESQUEMA)
+CHAVES_ATRIBUTOS = ESQUEMA_COMPILADO.chaves
+
+Automato = namedtuple("Automato", ["transicoes", "falha", "saidas", "prefixo"])
+
+def construir_automato(chaves):
+    """
+    Monta o autômato de Aho-Corasick das chaves. Com ele, uma única passada pelo texto de uma célula
+    encontra todas as chaves contidas nela, com a mesma semântica de 'chave in texto'.
+    """
+    chaves = list(dict.fromkeys(chaves))
+    transicoes = [{}]
+    saidas = [[]]
+    for chave in chaves:
+        estado = 0
+        for caractere in chave:
+            if caractere not in transicoes[estado]:
+                transicoes.append({})
+                saidas.append([])
+                transicoes[estado][caractere] = len(transicoes) - 1
+            estado = transicoes[estado][caractere]
+        saidas[estado].append(chave)
+    falha = [0] * len(transicoes)
+    fila = deque(transicoes[0].values())
+    while fila:
+        estado = fila.popleft()
+        for caractere, proximo in transicoes[estado].items():
+            fila.append(proximo)
+            f = falha[estado]
+            while f and caractere not in transicoes[f]:
+                f = falha[f]
+            falha[proximo] = transicoes[f].get(caractere, 0)
+            saidas[proximo] = saidas[proximo] + saidas[falha[proximo]]
+    # Células sem o prefixo comum a todas as chaves não precisam passar pelo autômato
+    return Automato(transicoes, falha, saidas, os.path.commonprefix(chaves))
+
+def buscar_chaves(automato, texto):
+    """
+    Retorna as chaves contidas no texto, sem repetição, na ordem em que terminam.
+    """
+    if automato.prefixo not in texto:
+        return []
+    transicoes, falha, saidas = automato.transicoes, automato.falha, automato.saidas
+    estado = 0
+    achadas = []
+    for caractere in texto:
+        while estado and caractere not in transicoes[estado]:
+            estado = falha[estado]
+        estado = transicoes[estado].get(caractere, 0)
+        if saidas[estado]:
+            achadas.extend(saidas[estado])
+    return list(dict.fromkeys(achadas))
+
+def localizar_chaves(automato, linhas, inicio=0):
+    """
+    Percorre as linhas (sequências de células) uma única vez e gera (linha, coluna, chave, células)
+    para cada chave encontrada, na ordem do arquivo. 'inicio' é o número da primeira linha.
+    """
+    for i, linha in enumerate(linhas, inicio):
+        for col, celula in enumerate(linha):
+            for chave in buscar_chaves(automato, str(celula)):
+                yield i, col, chave, linha
+
+AUTOMATO_CHAVES = construir_automato(ESQUEMA_COMPILADO.chaves + [CHAVE_COMPRIMENTO, CHAVE_ANGULO])
+
+def indexar_blocos(df, automato=None):
+    """
+    Divide o DataFrame em blocos de módulo, de uma linha 'AT-' até a próxima, em uma única passada.
+    Cada bloco guarda a primeira ocorrência de cada chave do autômato (valor da coluna seguinte) e o
+    primeiro ângulo válido para a curva. Chaves ausentes no bloco herdam o valor dos blocos seguintes,
+    como na busca original, que seguia até o fim do arquivo.
+    Retorna a lista de (linha, código, mapa, ângulo) na ordem do arquivo.
+    """
+    automato = automato or AUTOMATO_CHAVES
+    blocos = []
+    mapa = None
+    for i, linha in enumerate(df.itertuples(index=False, name=None)):
+        if mapa is not None:
+            for col, celula in enumerate(linha):
+                achadas = buscar_chaves(automato, str(celula))
+                if not achadas:
+                    continue
+                valor = linha[col + 1] if col + 1 < len(linha) else None
+                for chave in achadas:
+                    if chave not in mapa:
+                        mapa[chave] = valor
+                if CHAVE_ANGULO in achadas and "angulo" not in mapa["__curva__"] and valor in [30, 45, 60, 90]:
+                    mapa["__curva__"]["angulo"] = valor
+        codigo = str(linha[2]).strip() if len(linha) > 2 else None
+        if codigo and codigo.startswith("AT-"):
+            mapa = {"__curva__": {}}
+            blocos.append((i, codigo, mapa))
+    # Propaga de trás para frente o que não foi encontrado dentro de cada bloco
+    seguinte = {"__curva__": {}}
+    resultado = []
+    for i, codigo, mapa in reversed(blocos):
+        curva = mapa.pop("__curva__")
+        for chave, valor in seguinte.items():
+            mapa.setdefault(chave, valor)
+        if "angulo" not in curva and "angulo" in seguinte["__curva__"]:
+            curva["angulo"] = seguinte["__curva__"]["angulo"]
+        seguinte = dict(mapa, __curva__=curva)
+        resultado.append((i, codigo, mapa, curva.get("angulo")))
+    resultado.reverse()
+    return resultado
+
+def extrair_dados(df, tipo, numero, data_criacao, customer, modo=None):
     """
     Extrai os dados dos códigos que começam com 'AT-' e suas quantidades.
     Inverte os dados: o 'AT-' vai para a coluna 'Module', e o número vai para 'Sales Order' ou 'Quotation'.
+    O caminho de extração é escolhido por 'modo' (padrão MODO_EXTRACAO); todos geram as mesmas linhas.
+    """
+    extrator = MODOS_EXTRACAO[modo or MODO_EXTRACAO]
+    return extrator(df, tipo, numero, data_criacao, customer)
+
+def extrair_dados_blocos(df, tipo, numero, data_criacao, customer):
+    """
+    Percorre o arquivo uma única vez (indexar_blocos) e tira os atributos do mapa de cada bloco.
+    """
+    dados = []
+    for i, codigo, mapa, angulo in indexar_blocos(df):
+        contexto = {"numero": numero, "codigo": codigo, "angulo": angulo,
+                    "data_criacao": data_criacao, "customer": customer}
+        dados.append(ESQUEMA_COMPILADO.montar(mapa, df.iloc[i], contexto))
+    return dados
+
+def extrair_dados_vetorizado(df, tipo, numero, data_criacao, customer):
+    """
+    Converte o DataFrame uma única vez em um array de strings do NumPy e localiza as linhas 'AT-'
+    e as chaves com máscaras vetorizadas. O valor de cada chave (coluna seguinte) vem por indexação
+    do array, e a primeira ocorrência depois de cada linha 'AT-' sai de um searchsorted.
+    """
+    valores = df.to_numpy(dtype=object)
+    if valores.size == 0 or valores.shape[1] <= 2:
+        return []
+    n_linhas, n_colunas = valores.shape
+    textos = valores.astype(str)
+    codigos = np.char.strip(textos[:, 2])
+    ancoras = np.flatnonzero(np.char.startswith(codigos, "AT-"))
+    if len(ancoras) == 0:
+        return []
+
+    # Só as células com o prefixo comum entram na busca por cada chave
+    linhas_cand, colunas_cand = np.nonzero(np.char.find(textos, PREFIXO_CHAVES) >= 0)
+    textos_cand = textos[linhas_cand, colunas_cand]
+    posicoes_cand = linhas_cand * n_colunas + colunas_cand
+    inicio_busca = (ancoras + 1) * n_colunas
+
+    def primeira_ocorrencia(mascara):
+        # Índice (em linhas_cand) da primeira ocorrência após cada âncora, ou -1
+        posicoes = np.flatnonzero(mascara)
+        if len(posicoes) == 0:
+            return np.full(len(ancoras), -1)
+        idx = np.searchsorted(posicoes_cand[posicoes], inicio_busca)
+        return np.where(idx < len(posicoes), posicoes[np.minimum(idx, len(posicoes) - 1)], -1)
+
+    def valor_seguinte(k):
+        col = colunas_cand[k] + 1
+        return valores[linhas_cand[k], col] if col < n_colunas else None
+
+    achados = {}
+    for chave in ESQUEMA_COMPILADO.chaves:
+        achados[chave] = primeira_ocorrencia(np.char.find(textos_cand, chave) >= 0)
+    mascara_angulo = np.char.find(textos_cand, CHAVE_ANGULO) >= 0
+    for k in np.flatnonzero(mascara_angulo):
+        mascara_angulo[k] = valor_seguinte(k) in [30, 45, 60, 90]
+    achados_angulo = primeira_ocorrencia(mascara_angulo)
+
+    dados = []
+    for n, i in enumerate(ancoras):
+        mapa = {chave: valor_seguinte(k[n]) for chave, k in achados.items() if k[n] >= 0}
+        angulo = valor_seguinte(achados_angulo[n]) if achados_angulo[n] >= 0 else None
+        contexto = {"numero": numero, "codigo": str(codigos[i]), "angulo": angulo,
+                    "data_criacao": data_criacao, "customer": customer}
+        dados.append(ESQUEMA_COMPILADO.montar(mapa, valores[i], contexto))
+    return dados
+
+def extrair_dados_streaming(linhas, tipo, numero, data_criacao, customer, automato=None):
+    """
+    Versão de extrair_dados sobre as linhas de processar_csv_streaming, sem DataFrame.
+    Cada módulo é emitido assim que todas as suas chaves foram encontradas. Como na busca original,
+    uma chave ausente no bloco é procurada nos blocos seguintes, então só os módulos ainda
+    incompletos ficam em memória (no pior caso até o fim do arquivo). Cada chave guarda a lista
+    dos módulos que ainda esperam por ela, então uma chave encontrada é entregue a todos eles de
+    uma vez, sem percorrer os módulos abertos a cada célula.
+    """
+    automato = automato or AUTOMATO_CHAVES
+    chaves = ESQUEMA_COMPILADO.chaves
+    abertos = deque()  # [linha 'AT-', código, mapa, ângulo, chaves faltando]
+    esperando = {chave: [] for chave in chaves}
+    curvas_sem_angulo = []
+
+    def completo(bloco):
+        return not bloco[4] and (bloco[1] != CODIGO_CURVA or bloco[3] is not None)
+
+    def montar(bloco):
+        linha, codigo, mapa, angulo, _ = bloco
+        contexto = {"numero": numero, "codigo": codigo, "angulo": angulo,
+                    "data_criacao": data_criacao, "customer": customer}
+        return ESQUEMA_COMPILADO.montar(mapa, linha, contexto)
+
+    for linha in linhas:
+        if abertos:
+            for col, celula in enumerate(linha):
+                achadas = buscar_chaves(automato, str(celula))
+                if not achadas:
+                    continue
+                valor = linha[col + 1] if col + 1 < len(linha) else None
+                for chave in achadas:
+                    if esperando.get(chave):
+                        for bloco in esperando[chave]:
+                            bloco[2][chave] = valor
+                            bloco[4] -= 1
+                        esperando[chave] = []
+                if CHAVE_ANGULO in achadas and curvas_sem_angulo and valor in [30, 45, 60, 90]:
+                    for bloco in curvas_sem_angulo:
+                        bloco[3] = valor
+                    curvas_sem_angulo = []
+            while abertos and completo(abertos[0]):
+                yield montar(abertos.popleft())
+        codigo = str(linha[2]).strip() if len(linha) > 2 else None
+        if codigo and codigo.startswith("AT-"):
+            bloco = [linha, codigo, {}, None, len(chaves)]
+            abertos.append(bloco)
+            for chave in chaves:
+                esperando[chave].append(bloco)
+            if codigo == CODIGO_CURVA:
+                curvas_sem_angulo.append(bloco)
+    for bloco in abertos:
+        yield montar(bloco)
+
+def extrair_dados_linear(df, tipo, numero, data_criacao, customer):
+    """
+    Caminho original de extração: para cada linha 'AT-' busca cada chave nas linhas seguintes.
+    Mantido para conferência dos resultados de extrair_dados.
     """
     dados = []
     for i, row in df.iterrows():
@@ -106,22 +895,21 @@ def extrair_dados(df, tipo, numero, data_criacao, customer):
 def buscar_comprimento(df, index, codigo):
     """
     Busca o comprimento relacionado a 'AT_MCP2_MOD_LEN_M' ou aplica regra especial para 'AT-RM8320-E2'.
+    As duas chaves são localizadas na mesma passada pelas linhas seguintes.
     """
     try:
-        if codigo == "AT-RM8320-E2":
-            for i in range(index + 1, len(df)):  # Busca nas linhas seguintes
-                row = df.iloc[i]
-                for col in range(len(row)):
-                    if "AT_MCP2_FKT_ANG" in str(row[col]):
-                        angulo = row[col + 1] if col + 1 < len(row) else None
-                        if angulo in [30, 45, 60, 90]:
-                            return {30: 542, 45: 813, 60: 1084, 90: 1626}.get(angulo, 0)
-        for i in range(index + 1, len(df)):  # Busca nas linhas seguintes
-            row = df.iloc[i]
-            for col in range(len(row)):
-                if "AT_MCP2_MOD_LEN_M" in str(row[col]):
-                    valor = row[col + 1] if col + 1 < len(row) else None
-                    return int(float(valor)) if str(valor).replace('.', '', 1).isdigit() else 0
+        linhas = df.iloc[index + 1:].itertuples(index=False, name=None)
+        comprimento = None
+        for i, col, chave, row in localizar_chaves(AUTOMATO_CHAVES, linhas, index + 1):
+            valor = row[col + 1] if col + 1 < len(row) else None
+            if chave == CHAVE_ANGULO and codigo == CODIGO_CURVA and valor in [30, 45, 60, 90]:
+                return COMPRIMENTO_CURVA.get(valor, 0)
+            if chave == CHAVE_COMPRIMENTO and comprimento is None:
+                comprimento = int(float(valor)) if str(valor).replace('.', '', 1).isdigit() else 0
+                if codigo != CODIGO_CURVA:
+                    return comprimento
+        if comprimento is not None:
+            return comprimento
     except Exception as e:
         print(f"Erro ao buscar comprimento: {e}")
     return 0
@@ -144,6 +932,12 @@ def buscar_informacao(df, index, chave):
         print(f"Erro ao buscar a informação '{chave}': {e}")
     return 0
 
+MODOS_EXTRACAO = {
+    "blocos": extrair_dados_blocos,
+    "vetorizado": extrair_dados_vetorizado,
+    "linear": extrair_dados_linear,
+}
+
 def ajustar_coluna(ws, start_row):
     """
     Ajusta a primeira coluna da aba removendo os dois últimos caracteres a partir de uma linha específica.
@@ -193,13 +987,7 @@ def salvar_em_excel(sales_orders_data, quotations_data, caminho_destino, nome_ar
             atualizar_tabela_existente(sales_orders_ws, sales_orders_data)
         else:
             sales_orders_ws = wb.create_sheet("Sales Orders")
-            sales_orders_ws.append(["Sales Order", "Module", "Quantity", "Length", "Between Frames", "Pitch", "Gear Ratio", 
-                                    "Power (W)", "Voltage (V)", "Interface Type", "Sensor Type", "TOR", "Control Card", 
-                                    "Zone Length", "Eletric Side", "Side Guide Left Type", "Side Guide Right Type", 
-                                    "Bus Type", "MSC Quantity", "Merge/Divert", "Merge/Divert Angle", "Alignment Angle", 
-                                    "Motor Position", "Motor Manufacturer", "Framebed Type", "Sword Quantity", 
-                                    "Cassetes Quantity", "Lower Conveyor Height (TOR1)", "Higher Conveyor Height (TOR21)", 
-                                    "Support Type", "Creation Date", "Delivery Date", "Customer"])
+            sales_orders_ws.append(ESQUEMA_COMPILADO.cabecalhos["Sales Orders"])
             for item in sales_orders_data:
                 sales_orders_ws.append(item)
             formatar_como_tabela(sales_orders_ws, "SalesOrdersTable")
@@ -210,62 +998,517 @@ def salvar_em_excel(sales_orders_data, quotations_data, caminho_destino, nome_ar
             atualizar_tabela_existente(quotations_ws, quotations_data)
         else:
             quotations_ws = wb.create_sheet("Quotations")
-            quotations_ws.append(["Quotation", "Module", "Quantity", "Module Length", "Between Frames", "Pitch", "Gear Ratio", 
-                                  "Power (W)", "Voltage (V)", "Interface Type", "Sensor Type", "TOR", "Control Card", 
-                                  "Zone Length", "Eletric Side", "Side Guide Left Type", "Side Guide Right Type", 
-                                  "Bus Type", "MSC Quantity", "Merge/Divert", "Merge/Divert Angle", "Alignment Angle", 
-                                  "Motor Position", "Motor Manufacturer", "Framebed Type", "Sword Quantity", 
-                                  "Cassetes Quantity", "Lower Conveyor Height (TOR1)", "Higher Conveyor Height (TOR21)", 
-                                  "Support Type", "Creation Date", "Delivery Date", "Customer"])
+            quotations_ws.append(ESQUEMA_COMPILADO.cabecalhos["Quotations"])
             for item in quotations_data:
                 quotations_ws.append(item)
             formatar_como_tabela(quotations_ws, "QuotationsTable")
 
-        wb.save(caminho_completo)
+        # Salva ao lado e troca de uma vez: quem abrir a planilha nunca vê um arquivo pela metade
+        descritor, caminho_temporario = tempfile.mkstemp(suffix=".xlsx", dir=caminho_destino)
+        os.close(descritor)
+        try:
+            wb.save(caminho_temporario)
+            os.replace(caminho_temporario, caminho_completo)
+        finally:
+            if os.path.exists(caminho_temporario):
+                os.remove(caminho_temporario)
+        print(f"Arquivo Excel salvo com sucesso em: {caminho_completo}")
+        return True
+    except Exception as e:
+        print(f"Erro ao salvar o arquivo Excel: {e}")
+        return False
+
+def celula_xml(referencia, valor):
+    """
+    Gera o XML de uma célula: número como 'n', texto como inlineStr. Células vazias não são gravadas.
+    """
+    if valor is None:
+        return ""
+    if isinstance(valor, bool):
+        return f'<c r="{referencia}" t="b"><v>{int(valor)}</v></c>'
+    if isinstance(valor, (int, float)):
+        return f'<c r="{referencia}" t="n"><v>{valor}</v></c>'
+    texto = escape(re.sub(r"[\x00-\x08\x0b\x0c\x0e-\x1f]", "", str(valor)))
+    espaco = ' xml:space="preserve"' if texto != texto.strip() else ""
+    return f'<c r="{referencia}" t="inlineStr"><is><t{espaco}>{texto}</t></is></c>'
+
+def linhas_xml(dados, primeira_linha):
+    """
+    Gera o XML das linhas a partir de primeira_linha. Como em atualizar_tabela_existente,
+    os dois últimos caracteres da coluna A são removidos.
+    """
+    partes = []
+    for n, item in enumerate(dados, primeira_linha):
+        celulas = []
+        for c, valor in enumerate(item, 1):
+            if c == 1 and valor and isinstance(valor, str):
+                valor = valor[:-2]
+            celulas.append(celula_xml(f"{get_column_letter(c)}{n}", valor))
+        partes.append(f'<row r="{n}">{"".join(celulas)}</row>')
+    return "".join(partes)
+
+def ultima_linha_aba(origem):
+    """
+    Percorre o XML da aba em blocos e retorna o número da última linha ('<row r="...">').
+    """
+    linha_re = re.compile(rb'<row\b[^>]*?\sr="(\d+)"')
+    ultima = 0
+    resto = b""
+    while True:
+        bloco = origem.read(1024 * 1024)
+        if not bloco:
+            return ultima
+        janela = resto + bloco
+        for achado in linha_re.finditer(janela):
+            ultima = max(ultima, int(achado.group(1)))
+        # A tag pode estar dividida entre dois blocos
+        resto = janela[max(janela.rfind(b"<"), 0):]
+
+def anexar_linhas_aba(origem, destino, dados, ultima_linha, xml_linhas=None):
+    """
+    Copia o XML da aba para destino em blocos, inserindo as novas linhas depois de ultima_linha,
+    antes de '</sheetData>', e atualizando '<dimension>'. xml_linhas é o XML das novas linhas, se já gerado.
+    """
+    pendente = b""
+    while b"<sheetData" not in pendente:
+        bloco = origem.read(64 * 1024)
+        if not bloco:
+            raise ValueError("Aba sem '<sheetData>'")
+        pendente += bloco
+    largura = max([len(item) for item in dados] + [1])
+    dimensao = re.search(rb'<dimension ref="[A-Z]+\d+(?::([A-Z]+)\d+)?"\s*/>', pendente)
+    if dimensao:
+        if dimensao.group(1):
+            largura = max(largura, column_index_from_string(dimensao.group(1).decode()))
+        referencia = f"A1:{get_column_letter(largura)}{ultima_linha + len(dados)}"
+        pendente = pendente[:dimensao.start()] + f'<dimension ref="{referencia}"/>'.encode() + pendente[dimensao.end():]
+    fim_dados = re.compile(rb"</sheetData>|<sheetData\s*/>")
+    while True:
+        achado = fim_dados.search(pendente)
+        if achado:
+            abertura = b"<sheetData>" if achado.group().startswith(b"<sheetData") else b""
+            destino.write(pendente[:achado.start()] + abertura)
+            destino.write(xml_linhas if xml_linhas is not None else linhas_xml(dados, ultima_linha + 1).encode("utf-8"))
+            destino.write(b"</sheetData>" + pendente[achado.end():])
+            shutil.copyfileobj(origem, destino)
+            return
+        bloco = origem.read(1024 * 1024)
+        if not bloco:
+            raise ValueError("Aba sem '</sheetData>'")
+        # Mantém o final do bloco, onde a tag de fechamento pode ter sido cortada
+        corte = max(len(pendente) - 16, 0)
+        destino.write(pendente[:corte])
+        pendente = pendente[corte:] + bloco
+
+def partes_tabelas_aba(zip_xlsx, caminho_aba):
+    """
+    Retorna os caminhos das tabelas (xl/tables/table*.xml) ligadas à aba.
+    """
+    pasta, nome = posixpath.split(caminho_aba)
+    caminho_rels = posixpath.join(pasta, "_rels", nome + ".rels")
+    if caminho_rels not in zip_xlsx.namelist():
+        return []
+    tabelas = []
+    for relacao in ET.fromstring(zip_xlsx.read(caminho_rels)).iter(f"{NS_PACOTE}Relationship"):
+        if relacao.get("Type", "").endswith("/table"):
+            alvo = relacao.get("Target")
+            tabelas.append(alvo.lstrip("/") if alvo.startswith("/") else posixpath.normpath(posixpath.join(pasta, alvo)))
+    return tabelas
+
+def anexar_em_excel(sales_orders_data, quotations_data, caminho_destino, nome_arquivo):
+    """
+    Acrescenta as linhas às abas 'Sales Orders' e 'Quotations' sem carregar a planilha: só o XML
+    dessas abas e das suas tabelas é reescrito; as demais partes do arquivo são copiadas como estão.
+    Se a planilha ou as abas ainda não existirem, usa salvar_em_excel.
+    """
+    caminho_completo = os.path.join(caminho_destino, nome_arquivo)
+    if not os.path.exists(caminho_completo):
+        return salvar_em_excel(sales_orders_data, quotations_data, caminho_destino, nome_arquivo)
+    caminho_temporario = None
+    try:
+        inicio = time.time()
+        novos = {"Sales Orders": sales_orders_data, "Quotations": quotations_data}
+        with zipfile.ZipFile(caminho_completo) as zip_origem:
+            caminhos = caminhos_abas_xlsx(zip_origem)
+            if any(aba not in caminhos for aba in novos):
+                return salvar_em_excel(sales_orders_data, quotations_data, caminho_destino, nome_arquivo)
+            abas = {caminhos[aba]: dados for aba, dados in novos.items() if dados}
+            if not abas:
+                print("Nenhuma linha nova para acrescentar à planilha.")
+                return True
+            ultimas = {}
+            aba_da_tabela = {}
+            for caminho in abas:
+                with zip_origem.open(caminho) as origem:
+                    ultimas[caminho] = ultima_linha_aba(origem)
+                for tabela in partes_tabelas_aba(zip_origem, caminho):
+                    aba_da_tabela[tabela] = caminho
+            xml_novas = {caminho: linhas_xml(dados, ultimas[caminho] + 1).encode("utf-8")
+                         for caminho, dados in abas.items()}
+            descritor, caminho_temporario = tempfile.mkstemp(suffix=".xlsx", dir=caminho_destino)
+            os.close(descritor)
+            with zipfile.ZipFile(caminho_temporario, "w") as zip_destino:
+                for info in zip_origem.infolist():
+                    nova_info = zipfile.ZipInfo(info.filename, info.date_time)
+                    nova_info.compress_type = info.compress_type
+                    nova_info.external_attr = info.external_attr
+                    # Zip64 só na parte que pode passar de 2 GiB com as linhas novas (folga para <dimension> e ref)
+                    zip64 = info.file_size + len(xml_novas.get(info.filename, b"")) + 1024 > zipfile.ZIP64_LIMIT
+                    with zip_destino.open(nova_info, "w", force_zip64=zip64) as destino:
+                        if info.filename in abas:
+                            with zip_origem.open(info) as origem:
+                                anexar_linhas_aba(origem, destino, abas[info.filename], ultimas[info.filename],
+                                                  xml_novas[info.filename])
+                        elif info.filename in aba_da_tabela:
+                            # Mantém as colunas da tabela e estende a área até a nova última linha
+                            caminho_aba = aba_da_tabela[info.filename]
+                            ultima = ultimas[caminho_aba] + len(abas[caminho_aba])
+                            xml = zip_origem.read(info).decode("utf-8")
+                            xml = re.sub(r'(<(?:table|autoFilter)\b[^>]*?\sref="[A-Z]+\d+:[A-Z]+)\d+"',
+                                         rf'\g<1>{ultima}"', xml, count=2)
+                            destino.write(xml.encode("utf-8"))
+                        else:
+                            with zip_origem.open(info) as origem:
+                                shutil.copyfileobj(origem, destino)
+        # Só troca o arquivo depois de fechar o original (no Windows o arquivo aberto não pode ser substituído)
+        os.replace(caminho_temporario, caminho_completo)
+        print(f"Linhas acrescentadas em {time.time() - inicio:.2f}s: "
+              + ", ".join(f"{aba} {len(dados)}" for aba, dados in novos.items()))
         print(f"Arquivo Excel salvo com sucesso em: {caminho_completo}")
+        return True
     except Exception as e:
         print(f"Erro ao salvar o arquivo Excel: {e}")
+        return False
+    finally:
+        # Falha na cópia ou na troca (ex.: planilha aberta no Excel) não deixa o temporário na pasta do BI
+        if caminho_temporario is not None and os.path.exists(caminho_temporario):
+            os.remove(caminho_temporario)
+
+# Situações em que o arquivo não precisa ser lido de novo enquanto tamanho e data não mudarem
+STATUS_CONCLUIDOS = ("processado", "existente", "ignorado", "duplicado", "repetido")
+# Situações em que o conteúdo do arquivo já está na planilha (ou não tem o que gravar): um
+# conteúdo igual a um destes é um duplicado
+STATUS_CONTEUDO_CONFIRMADO = ("processado", "existente", "ignorado", "repetido")
+# Situações que só entram no registro se a gravação do lote deu certo ('repetido' é um número que
+# já veio de outro arquivo do mesmo lote)
+STATUS_DEPENDENTES_GRAVACAO = ("processado", "duplicado", "repetido")
+
+def abrir_registro(caminho_registro):
+    """
+    Abre (ou cria) o registro SQLite dos arquivos de origem já processados.
+    """
+    conexao = sqlite3.connect(caminho_registro)
+    conexao.execute("""
+        CREATE TABLE IF NOT EXISTS arquivos_processados (
+            caminho TEXT PRIMARY KEY,
+            tamanho INTEGER,
+            mtime REAL,
+            hash TEXT,
+            numero TEXT,
+            tipo TEXT,
+            linhas INTEGER,
+            status TEXT,
+            processado_em TEXT
+        )
+    """)
+    conexao.execute("CREATE INDEX IF NOT EXISTS idx_arquivos_numero ON arquivos_processados (numero)")
+    conexao.execute("""
+        CREATE TABLE IF NOT EXISTS snapshot_diretorios (
+            diretorio TEXT PRIMARY KEY,
+            mtime REAL
+        )
+    """)
+    conexao.execute("""
+        CREATE TABLE IF NOT EXISTS snapshot_arquivos (
+            caminho TEXT PRIMARY KEY,
+            diretorio TEXT,
+            nome TEXT,
+            tamanho INTEGER,
+            mtime REAL,
+            ctime REAL
+        )
+    """)
+    conexao.execute("CREATE INDEX IF NOT EXISTS idx_snapshot_diretorio ON snapshot_arquivos (diretorio)")
+    # Hash de cada caminho lido, válido enquanto tamanho e data não mudarem. A tabela anterior
+    # (hashes_conteudo, por tamanho + data) reconhecia como cópia um arquivo diferente de mesmo tamanho
+    conexao.execute("DROP TABLE IF EXISTS hashes_conteudo")
+    conexao.execute("""
+        CREATE TABLE IF NOT EXISTS hashes_arquivos (
+            caminho TEXT PRIMARY KEY,
+            tamanho INTEGER,
+            mtime REAL,
+            hash TEXT
+        )
+    """)
+    conexao.commit()
+    return conexao
+
+def carregar_registro(conexao):
+    """
+    Retorna {caminho: (tamanho, mtime)} dos arquivos concluídos, para a checagem só com os dados da listagem.
+    """
+    cursor = conexao.execute(
+        f"SELECT caminho, tamanho, mtime FROM arquivos_processados WHERE status IN ({','.join('?' * len(STATUS_CONCLUIDOS))})",
+        STATUS_CONCLUIDOS)
+    return {caminho: (tamanho, mtime) for caminho, tamanho, mtime in cursor}
+
+def arquivo_registrado(registro, arquivo):
+    """
+    Verifica se o arquivo já foi concluído com o mesmo tamanho e data de modificação.
+    """
+    return registro.get(arquivo.caminho) == (arquivo.tamanho, arquivo.mtime)
+
+def registrar_arquivos(conexao, entradas, salvo=True):
+    """
+    Grava no registro uma lista de (arquivo, hash, número, tipo, linhas, status) e guarda o hash
+    de cada arquivo lido por caminho + tamanho + data de modificação. Se a gravação do lote falhou
+    (salvo=False), os processados e os duplicados ficam fora do registro: o original de um
+    duplicado pode ser justamente um arquivo que não chegou à planilha.
+    """
+    agora = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    conexao.executemany(
+        "INSERT OR REPLACE INTO arquivos_processados VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [(arquivo.caminho, arquivo.tamanho, arquivo.mtime, hash_conteudo, numero, tipo, linhas, status, agora)
+         for arquivo, hash_conteudo, numero, tipo, linhas, status in entradas
+         if salvo or status not in STATUS_DEPENDENTES_GRAVACAO])
+    conexao.executemany(
+        "INSERT OR REPLACE INTO hashes_arquivos VALUES (?, ?, ?, ?)",
+        [(arquivo.caminho, arquivo.tamanho, arquivo.mtime, hash_conteudo)
+         for arquivo, hash_conteudo, _, _, _, _ in entradas if hash_conteudo is not None])
+    conexao.commit()
+
+def carregar_hashes(conexao):
+    """
+    Retorna o cache {caminho: ((tamanho, mtime), hash)} dos arquivos já lidos e {hash: caminho}
+    dos conteúdos confirmados (STATUS_CONTEUDO_CONFIRMADO). O cache só evita ler de novo o mesmo
+    caminho; um arquivo em outro caminho é comparado pelo hash do seu conteúdo.
+    """
+    cache = {caminho: ((tamanho, mtime), hash_conteudo) for caminho, tamanho, mtime, hash_conteudo
+             in conexao.execute("SELECT caminho, tamanho, mtime, hash FROM hashes_arquivos")}
+    cursor = conexao.execute(
+        f"SELECT hash, caminho FROM arquivos_processados WHERE hash IS NOT NULL "
+        f"AND status IN ({','.join('?' * len(STATUS_CONTEUDO_CONFIRMADO))})", STATUS_CONTEUDO_CONFIRMADO)
+    return cache, dict(cursor)
+
+def hash_em_cache(cache_hashes, arquivo):
+    """
+    Hash guardado para o arquivo, se o mesmo caminho foi lido com o mesmo tamanho e data; senão None.
+    """
+    assinatura, hash_conteudo = cache_hashes.get(arquivo.caminho, (None, None))
+    return hash_conteudo if assinatura == (arquivo.tamanho, arquivo.mtime) else None
+
+Diferenca = namedtuple("Diferenca", ["novos", "alterados", "removidos"])
+Varredura = namedtuple("Varredura", ["arquivos", "diferenca", "listagens"])
+
+def descobrir_com_snapshot(conexao, diretorios, extensao=".csv", completo=False):
+    """
+    Compara cada diretório com o retrato salvo no registro. Se a data de modificação do diretório
+    não mudou, os arquivos vêm do retrato sem listar a pasta na rede; senão a pasta é relistada.
+    A data do diretório só muda quando entram ou saem arquivos, então um arquivo sobrescrito numa
+    pasta sem novidades só é visto com completo=True.
+    Retorna Varredura(todos os arquivos atuais, Diferenca(novos, alterados, removidos),
+    listagens {diretorio: (mtime, arquivos)} a gravar com salvar_snapshot).
+    """
+    mtimes_anteriores = dict(conexao.execute("SELECT diretorio, mtime FROM snapshot_diretorios"))
+    anteriores = {}
+    for caminho, diretorio, nome, tamanho, mtime, ctime in conexao.execute("SELECT * FROM snapshot_arquivos"):
+        anteriores.setdefault(diretorio, []).append(ArquivoOrigem(caminho, nome, tamanho, mtime, ctime))
+
+    def verificar(diretorio):
+        try:
+            mtime_diretorio = os.stat(diretorio).st_mtime
+        except Exception as e:
+            print(f"Erro ao acessar o diretório {diretorio}: {e}")
+            return None, None
+        if not completo and mtimes_anteriores.get(diretorio) == mtime_diretorio:
+            return mtime_diretorio, None
+        return mtime_diretorio, listar_diretorio(diretorio, extensao)
+
+    if len(diretorios) > 1 and LISTAGEM_PARALELA:
+        with ThreadPoolExecutor(max_workers=len(diretorios)) as executor:
+            verificacoes = list(executor.map(verificar, diretorios))
+    else:
+        verificacoes = [verificar(diretorio) for diretorio in diretorios]
+
+    arquivos = []
+    novos, alterados, removidos = [], [], []
+    listagens = {}
+    for diretorio, (mtime_diretorio, listagem) in zip(diretorios, verificacoes):
+        antigos = anteriores.get(diretorio, [])
+        if listagem is None:
+            # Diretório sem mudanças (ou inacessível): vale o retrato anterior, sem diferença
+            arquivos.extend(antigos if mtime_diretorio is not None else [])
+            continue
+        listagens[diretorio] = (mtime_diretorio, listagem)
+        por_caminho = {arquivo.caminho: arquivo for arquivo in antigos}
+        for arquivo in listagem:
+            antigo = por_caminho.pop(arquivo.caminho, None)
+            if antigo is None:
+                novos.append(arquivo)
+            elif (antigo.tamanho, antigo.mtime) != (arquivo.tamanho, arquivo.mtime):
+                alterados.append(arquivo)
+        removidos.extend(por_caminho.values())
+        arquivos.extend(listagem)
+    return Varredura(arquivos, Diferenca(novos, alterados, removidos), listagens)
+
+def salvar_snapshot(conexao, listagens):
+    """
+    Substitui no registro o retrato dos diretórios relistados nesta execução.
+    """
+    for diretorio, (mtime_diretorio, arquivos) in listagens.items():
+        conexao.execute("DELETE FROM snapshot_arquivos WHERE diretorio = ?", (diretorio,))
+        conexao.executemany(
+            "INSERT OR REPLACE INTO snapshot_arquivos VALUES (?, ?, ?, ?, ?, ?)",
+            [(arquivo.caminho, diretorio, arquivo.nome, arquivo.tamanho, arquivo.mtime, arquivo.ctime)
+             for arquivo in arquivos])
+        conexao.execute("INSERT OR REPLACE INTO snapshot_diretorios VALUES (?, ?)", (diretorio, mtime_diretorio))
+    conexao.commit()
+
+NS_PLANILHA = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+NS_RELACOES = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+NS_PACOTE = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+def canonizar_numero(valor):
+    """
+    Forma canônica de um número de Sales Order/Quotation: sem espaços e sem o '.0' de quando
+    o número foi lido como float ('5753532.0' -> '5753532').
+    """
+    texto = str(valor).strip()
+    try:
+        numero = float(texto)
+    except ValueError:
+        return texto
+    return str(int(numero)) if numero.is_integer() else texto
+
+def caminhos_abas_xlsx(zip_xlsx):
+    """
+    Retorna {nome da aba: caminho do XML da aba dentro do zip}.
+    """
+    relacoes = ET.fromstring(zip_xlsx.read("xl/_rels/workbook.xml.rels"))
+    alvos = {}
+    for relacao in relacoes.iter(f"{NS_PACOTE}Relationship"):
+        alvo = relacao.get("Target")
+        alvos[relacao.get("Id")] = alvo.lstrip("/") if alvo.startswith("/") else posixpath.normpath(posixpath.join("xl", alvo))
+    workbook = ET.fromstring(zip_xlsx.read("xl/workbook.xml"))
+    return {aba.get("name"): alvos[aba.get(f"{NS_RELACOES}id")] for aba in workbook.iter(f"{NS_PLANILHA}sheet")}
+
+def ler_textos_compartilhados(zip_xlsx):
+    """
+    Lê a tabela de textos compartilhados (sharedStrings.xml), se existir.
+    """
+    if "xl/sharedStrings.xml" not in zip_xlsx.namelist():
+        return []
+    textos = []
+    for _, elem in ET.iterparse(zip_xlsx.open("xl/sharedStrings.xml")):
+        if elem.tag == f"{NS_PLANILHA}si":
+            textos.append("".join(t.text or "" for t in elem.iter(f"{NS_PLANILHA}t")))
+            elem.clear()
+    return textos
+
+def ler_ids_excel(arquivo_excel, abas=("Sales Orders", "Quotations")):
+    """
+    Lê apenas a coluna A das abas, em uma passada pelo zip com parse incremental do XML,
+    sem carregar a planilha. Retorna {aba: set de números canônicos}, sem o cabeçalho.
+    """
+    inicio = time.time()
+    ids = {aba: set() for aba in abas}
+    with zipfile.ZipFile(arquivo_excel) as zip_xlsx:
+        caminhos = caminhos_abas_xlsx(zip_xlsx)
+        compartilhados = None
+        for aba in abas:
+            if aba not in caminhos:
+                continue
+            for _, elem in ET.iterparse(zip_xlsx.open(caminhos[aba])):
+                if elem.tag == f"{NS_PLANILHA}c":
+                    ref = elem.get("r", "")
+                    if ref[:1] == "A" and ref[1:2].isdigit() and ref[1:] != "1":
+                        tipo = elem.get("t")
+                        if tipo == "inlineStr":
+                            valor = "".join(t.text or "" for t in elem.iter(f"{NS_PLANILHA}t"))
+                        else:
+                            v = elem.find(f"{NS_PLANILHA}v")
+                            valor = v.text if v is not None else None
+                            if tipo == "s" and valor is not None:
+                                if compartilhados is None:
+                                    compartilhados = ler_textos_compartilhados(zip_xlsx)
+                                valor = compartilhados[int(valor)]
+                        if valor is not None and valor.strip():
+                            ids[aba].add(canonizar_numero(valor))
+                elif elem.tag == f"{NS_PLANILHA}row":
+                    elem.clear()
+    print(f"Números lidos da planilha em {time.time() - inicio:.2f}s: "
+          + ", ".join(f"{aba} {len(numeros)}" for aba, numeros in ids.items()))
+    return ids
 
 def ler_numeros_excel(arquivo_excel):
-    xls = pd.ExcelFile(arquivo_excel)
-    sales_orders = pd.read_excel(xls, 'Sales Orders', usecols=[0], engine='openpyxl')
-    sales_orders_numeros = sales_orders.iloc[:, 0].drop_duplicates().astype(str).tolist()
-    quotations = pd.read_excel(xls, 'Quotations', usecols=[0], engine='openpyxl')
-    quotations_numeros = quotations.iloc[:, 0].drop_duplicates().astype(str).tolist()
-    return sales_orders_numeros, quotations_numeros
-
-def buscar_arquivos(diretorio, numeros):
-    arquivos_nao_correspondentes = []
-    for arquivo in os.listdir(diretorio):
-        caminho_completo = os.path.join(diretorio, arquivo)
-        if os.path.isfile(caminho_completo):
-            encontrado = False
-            for numero in numeros:
-                if numero in arquivo:
-                    encontrado = True
-                    break
-            if not encontrado:
-                arquivos_nao_correspondentes.append(arquivo)
-    return arquivos_nao_correspondentes
+    """
+    Retorna os conjuntos de números (canônicos) das abas Sales Orders e Quotations.
+    """
+    ids = ler_ids_excel(arquivo_excel)
+    return ids["Sales Orders"], ids["Quotations"]
 
-def gerar_log_entry(entry_type, message):
-    timestamp = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-    return f"{timestamp} - {entry_type}: {message}\n"
+PADRAO_NUMERO_SOLTO = re.compile(r"\d{7,}")
+Conciliacao = namedtuple("Conciliacao", ["correspondentes", "sem_correspondencia", "ausentes_no_disco"])
 
-def listar_arquivos_e_verificar(diretorios, arquivo_excel, log_file):
+def numeros_do_nome(nome_arquivo):
+    """
+    Números de documento de um nome de arquivo: o campo número quando o nome segue o padrão dos
+    uploads, senão toda sequência de 7 ou mais dígitos.
+    """
+    campos = interpretar_nome_arquivo(nome_arquivo)
+    if campos is not None:
+        return {campos.numero}
+    return set(PADRAO_NUMERO_SOLTO.findall(nome_arquivo))
+
+def conciliar_arquivos(arquivos, sales_numbers, quotations_numbers):
+    """
+    Cruza os arquivos com os números da planilha por conjuntos, extraindo os números de cada nome
+    uma única vez. Retorna Conciliacao(correspondentes [(arquivo, número, aba)],
+    sem_correspondencia [(arquivo, números)], ausentes_no_disco [(número, aba)]).
+    """
+    correspondentes = []
+    sem_correspondencia = []
+    encontrados = set()
+    todos_numeros = sales_numbers | quotations_numbers  # Montado uma vez, não a cada arquivo
+    for arquivo in arquivos:
+        numeros = {canonizar_numero(numero) for numero in numeros_do_nome(arquivo.nome)}
+        achados = numeros & todos_numeros
+        if not achados:
+            sem_correspondencia.append((arquivo, sorted(numeros)))
+            continue
+        encontrados |= achados
+        for numero in sorted(achados):
+            correspondentes.append((arquivo, numero, 'Sales Orders' if numero in sales_numbers else 'Quotations'))
+    ausentes_no_disco = [(numero, 'Sales Orders') for numero in sorted(sales_numbers - encontrados)] + \
+                        [(numero, 'Quotations') for numero in sorted(quotations_numbers - encontrados)]
+    return Conciliacao(correspondentes, sem_correspondencia, ausentes_no_disco)
+
+def listar_arquivos_e_verificar(diretorios, arquivo_excel, arquivo_relatorio=None):
+    """
+    Confere os arquivos dos diretórios contra a planilha e acrescenta ao relatório CSV uma linha por
+    arquivo ou número: data_hora;situacao;aba;numero;diretorio;arquivo, com situação
+    'correspondente', 'sem_correspondencia' ou 'ausente_no_disco'. Retorna a Conciliacao.
+    """
+    arquivo_relatorio = arquivo_relatorio or RELATORIO_CONFERENCIA
     sales_orders_numeros, quotations_numeros = ler_numeros_excel(arquivo_excel)
-    with open(log_file, 'a') as log:
-        log.write(gerar_log_entry("INFO", "Iniciando verificação de arquivos"))
-        for diretorio in diretorios:
-            log.write(gerar_log_entry("INFO", f"Verificando arquivos no diretório {diretorio}"))
-            arquivos_nao_correspondentes_sales_orders = buscar_arquivos(diretorio, sales_orders_numeros)
-            arquivos_nao_correspondentes_quotations = buscar_arquivos(diretorio, quotations_numeros)
-            arquivos_nao_correspondentes = list(set(arquivos_nao_correspondentes_sales_orders + arquivos_nao_correspondentes_quotations))
-            if arquivos_nao_correspondentes:
-                log.write(gerar_log_entry("ERROR", f"Arquivos não correspondentes encontrados: {arquivos_nao_correspondentes}"))
-            else:
-                log.write(gerar_log_entry("INFO", "Todos os arquivos correspondem aos números das planilhas"))
-        log.write("\n")
+    conciliacao = conciliar_arquivos(descobrir_arquivos(diretorios, extensao=None),
+                                     sales_orders_numeros, quotations_numeros)
+    agora = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    novo = not os.path.exists(arquivo_relatorio)
+    with open(arquivo_relatorio, 'a', newline='', encoding='utf-8-sig' if novo else 'utf-8') as relatorio:
+        escritor = csv.writer(relatorio, delimiter=';')
+        if novo:
+            escritor.writerow(["data_hora", "situacao", "aba", "numero", "diretorio", "arquivo"])
+        for arquivo, numero, tipo in conciliacao.correspondentes:
+            escritor.writerow([agora, "correspondente", tipo, numero, os.path.dirname(arquivo.caminho), arquivo.nome])
+        for arquivo, numeros in conciliacao.sem_correspondencia:
+            escritor.writerow([agora, "sem_correspondencia", "", ",".join(numeros), os.path.dirname(arquivo.caminho), arquivo.nome])
+        for numero, tipo in conciliacao.ausentes_no_disco:
+            escritor.writerow([agora, "ausente_no_disco", tipo, numero, "", ""])
+    print(f"Conferência: {len(conciliacao.correspondentes)} correspondentes, "
+          f"{len(conciliacao.sem_correspondencia)} sem correspondência, "
+          f"{len(conciliacao.ausentes_no_disco)} ausentes no disco")
+    return conciliacao
 
 def atualizar_barra_progresso(progress, passo_atual, total_passos, descricao, log, arquivos_lidos, total_arquivos, tempo_inicio):
     progress['value'] = (passo_atual / total_passos) * 100
@@ -284,79 +1527,1566 @@ def atualizar_barra_progresso(progress, passo_atual, total_passos, descricao, lo
         tempo_restante_str = "Tempo estimado restante: calculando..."
     log.set(f"Arquivos lidos: {arquivos_lidos} de {total_arquivos}\n{tempo_decorrido_str}\n{tempo_restante_str}")
 
-def executar_script():
+def classificar_arquivo(conteudo, sales_numbers, quotations_numbers, hash_conteudo=None):
+    """
+    Identifica a aba pelo número na primeira célula e verifica se ele já está na planilha.
+    Retorna (hash do conteúdo, primeira célula, aba, situação), com situação 'ignorado',
+    'existente' ou 'novo'.
+    """
+    if hash_conteudo is None:
+        hash_conteudo = hashlib.sha1(conteudo).hexdigest()
+    primeira_celula = ler_primeira_celula(conteudo)
+    if primeira_celula.startswith('5'):
+        tipo_arquivo = 'Sales Orders'
+    elif primeira_celula.startswith('2'):
+        tipo_arquivo = 'Quotations'
+    else:
+        return hash_conteudo, primeira_celula, None, "ignorado"
+
+    # Print informando qual número está sendo procurado
+    print(f"Procurando {tipo_arquivo} {primeira_celula}")
+
+    # Verificar se o número já existe no Excel
+    numero_canonico = canonizar_numero(primeira_celula)
+    if (tipo_arquivo == 'Sales Orders' and numero_canonico in sales_numbers) or \
+       (tipo_arquivo == 'Quotations' and numero_canonico in quotations_numbers):
+        print(f"Correspondência encontrada para o número {primeira_celula}")
+        return hash_conteudo, primeira_celula, tipo_arquivo, "existente"
+    print(f"Nenhuma correspondência encontrada para o número {primeira_celula}. Processando arquivo...")
+    return hash_conteudo, primeira_celula, tipo_arquivo, "novo"
+
+@contextmanager
+def travar_planilha(arquivo_excel, espera=None, limite=None):
+    """
+    Trava consultiva da planilha: cria arquivo_excel + '.lock' com o dono (usuário, máquina, pid e
+    hora) de forma exclusiva. Se outra execução estiver gravando, espera a vez em intervalos curtos
+    até espera segundos (TimeoutError depois disso). Uma trava mais antiga que limite é tratada como
+    abandonada: é renomeada (só uma execução consegue) e removida se ainda for a mesma.
+    Enquanto a trava está em uso, uma thread renova a data dela a cada RENOVACAO_TRAVA segundos.
+    """
+    espera = ESPERA_TRAVA if espera is None else espera
+    limite = TEMPO_LIMITE_TRAVA if limite is None else limite
+    caminho_trava = arquivo_excel + ".lock"
+    dono = f"{getpass.getuser()}@{socket.gethostname()} pid {os.getpid()} {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}"
     inicio = time.time()
-    descricao.set("Listando arquivos...")
-    root.update()
-    arquivos_csv = listar_arquivos(DIRETORIOS_ORIGEM)
-    atualizar_barra_progresso(progress, 1, total_passos, descricao, log, 0, len(arquivos_csv), inicio)
-    
-    # Carregar números já existentes do Excel
+    avisado = False
+    while True:
+        try:
+            descritor = os.open(caminho_trava, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                with open(caminho_trava, encoding="utf-8") as f:
+                    atual = f.read()
+                idade = time.time() - os.path.getmtime(caminho_trava)
+            except FileNotFoundError:
+                continue  # Liberada entre as duas chamadas
+            if idade > limite:
+                reivindicada = f"{caminho_trava}.{os.getpid()}.{time.time_ns()}"
+                try:
+                    os.rename(caminho_trava, reivindicada)
+                except FileNotFoundError:
+                    continue  # Outra execução reivindicou primeiro
+                with open(reivindicada, encoding="utf-8") as f:
+                    abandonada = f.read() == atual and time.time() - os.path.getmtime(reivindicada) > limite
+                if abandonada:
+                    print(f"Removendo trava abandonada da planilha ({atual}, {idade:.0f}s)")
+                else:
+                    # Entre a leitura e a renomeação outra execução trocou a trava: ela volta ao lugar
+                    try:
+                        os.link(reivindicada, caminho_trava)
+                    except FileExistsError:
+                        pass
+                    except OSError:
+                        # Compartilhamento sem hard link: devolve pelo nome, se ninguém criou outra
+                        if not os.path.exists(caminho_trava):
+                            os.rename(reivindicada, caminho_trava)
+                            continue
+                os.remove(reivindicada)
+                continue
+            if time.time() - inicio > espera:
+                raise TimeoutError(f"Planilha em uso por {atual} há mais de {espera}s")
+            if not avisado:
+                print(f"Aguardando a planilha, em gravação por {atual}")
+                avisado = True
+            time.sleep(0.5 + (os.getpid() % 10) / 20)
+            continue
+        with os.fdopen(descritor, "w", encoding="utf-8") as f:
+            f.write(dono)
+        break
+
+    def renovar(liberada):
+        # Uma gravação longa não pode parecer abandonada para outra execução
+        while not liberada.wait(RENOVACAO_TRAVA):
+            try:
+                with open(caminho_trava, encoding="utf-8") as f:
+                    if f.read() != dono:
+                        return
+                os.utime(caminho_trava)
+            except FileNotFoundError:
+                return
+
+    liberada = Event()
+    renovacao = Thread(target=renovar, args=(liberada,), daemon=True)
+    renovacao.start()
+    try:
+        yield
+    finally:
+        liberada.set()
+        renovacao.join()
+        try:
+            with open(caminho_trava, encoding="utf-8") as f:
+                minha = f.read() == dono
+            if minha:
+                os.remove(caminho_trava)
+        except FileNotFoundError:
+            pass
+
+def descartar_ja_gravados(arquivo_excel, sales_orders_data, quotations_data, entradas_registro, numeros_gravados,
+                          ids=None):
+    """
+    Com a trava obtida, relê a coluna A (ou usa ids, {aba: números} já conhecidos) e tira das linhas
+    a gravar os números que outra execução gravou enquanto esta extraía; os arquivos deles passam
+    a 'existente' no registro. Retorna as listas de linhas filtradas.
+    """
+    abas = [aba for aba, numeros in numeros_gravados.items() if numeros]
+    if not abas or (ids is None and not os.path.exists(arquivo_excel)):
+        return sales_orders_data, quotations_data
+    if ids is None:
+        ids = ler_ids_excel(arquivo_excel, abas)
+    repetidos = {aba: numeros_gravados[aba] & ids[aba] for aba in abas}
+    if not any(repetidos.values()):
+        return sales_orders_data, quotations_data
+    print(f"Já gravados por outra execução: {sum(len(numeros) for numeros in repetidos.values())} número(s)")
+    for aba, numeros in repetidos.items():
+        numeros_gravados[aba] -= numeros
+    for i, (arquivo, hash_conteudo, numero, tipo_arquivo, linhas, status) in enumerate(entradas_registro):
+        if status == "processado" and canonizar_numero(numero) in repetidos.get(tipo_arquivo, ()):
+            entradas_registro[i] = (arquivo, hash_conteudo, numero, tipo_arquivo, 0, "existente")
+    filtrar = lambda dados, aba: [linha for linha in dados if canonizar_numero(linha[0]) not in repetidos.get(aba, ())]
+    return filtrar(sales_orders_data, 'Sales Orders'), filtrar(quotations_data, 'Quotations')
+
+# Colunas da tabela modulos: o número canônico no lugar de Sales Order/Quotation e as demais com o
+# nome dos cabeçalhos da planilha
+COLUNAS_BANCO = ESQUEMA_COMPILADO.cabecalhos["Sales Orders"][1:]
+INDICE_DATA_CRIACAO = ESQUEMA_COMPILADO.cabecalhos["Sales Orders"].index("Creation Date")
+INDICE_DATA_ENTREGA = ESQUEMA_COMPILADO.cabecalhos["Sales Orders"].index("Delivery Date")
+
+def data_iso(valor):
+    """Converte 'dd/mm/aaaa' em 'aaaa-mm-dd' para os índices de data; None se não for uma data."""
+    try:
+        return datetime.strptime(str(valor).strip(), "%d/%m/%Y").strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+
+def abrir_banco(caminho_banco):
+    """
+    Abre (ou cria) o banco SQLite com uma linha por módulo: aba, número, posição do módulo no
+    documento e as colunas da planilha, com índices por número, módulo e datas.
+    """
+    conexao = sqlite3.connect(caminho_banco, timeout=ESPERA_TRAVA)
+    colunas = ", ".join(f'"{coluna}"' for coluna in COLUNAS_BANCO)
+    conexao.execute(f"""
+        CREATE TABLE IF NOT EXISTS modulos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            aba TEXT NOT NULL,
+            numero TEXT NOT NULL,
+            posicao INTEGER NOT NULL,
+            {colunas},
+            data_criacao TEXT,
+            data_entrega TEXT,
+            atualizado_em TEXT,
+            UNIQUE (aba, numero, posicao)
+        )
+    """)
+    conexao.execute("CREATE INDEX IF NOT EXISTS idx_modulos_numero ON modulos (numero)")
+    conexao.execute('CREATE INDEX IF NOT EXISTS idx_modulos_modulo ON modulos ("Module")')
+    conexao.execute("CREATE INDEX IF NOT EXISTS idx_modulos_data_criacao ON modulos (data_criacao)")
+    conexao.execute("CREATE INDEX IF NOT EXISTS idx_modulos_data_entrega ON modulos (data_entrega)")
+    conexao.commit()
+    return conexao
+
+def gravar_no_banco(conexao, sales_orders_data, quotations_data):
+    """
+    Grava as linhas no banco numa transação. Um documento gravado de novo substitui as linhas
+    anteriores (upsert por aba, número e posição; posições que sobraram são apagadas).
+    Retorna as partições (aba, mês de criação 'aaaa-mm' ou 'sem_data') com linhas novas ou
+    substituídas, incluindo o mês antigo de um documento reprocessado.
+    """
+    agora = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
+    colunas = ", ".join(f'"{coluna}"' for coluna in COLUNAS_BANCO)
+    atualizacoes = ", ".join(f'"{coluna}" = excluded."{coluna}"'
+                             for coluna in COLUNAS_BANCO + ["data_criacao", "data_entrega", "atualizado_em"])
+    linhas = []
+    quantidades = {}
+    for aba, dados in (("Sales Orders", sales_orders_data), ("Quotations", quotations_data)):
+        for linha in dados:
+            numero = canonizar_numero(linha[0])
+            posicao = quantidades.get((aba, numero), 0)
+            quantidades[(aba, numero)] = posicao + 1
+            linhas.append((aba, numero, posicao, *linha[1:], data_iso(linha[INDICE_DATA_CRIACAO]),
+                           data_iso(linha[INDICE_DATA_ENTREGA]), agora))
+    particoes = {(linha[0], linha[-3][:7] if linha[-3] else "sem_data") for linha in linhas}
+    with conexao:
+        for aba, numero in quantidades:
+            for data_criacao, in conexao.execute(
+                    "SELECT DISTINCT data_criacao FROM modulos WHERE aba = ? AND numero = ?", (aba, numero)):
+                particoes.add((aba, data_criacao[:7] if data_criacao else "sem_data"))
+        conexao.executemany(
+            f"INSERT INTO modulos (aba, numero, posicao, {colunas}, data_criacao, data_entrega, atualizado_em) "
+            f"VALUES ({', '.join('?' * (len(COLUNAS_BANCO) + 6))}) "
+            f"ON CONFLICT (aba, numero, posicao) DO UPDATE SET {atualizacoes}", linhas)
+        conexao.executemany("DELETE FROM modulos WHERE aba = ? AND numero = ? AND posicao >= ?",
+                            [(aba, numero, quantidade) for (aba, numero), quantidade in quantidades.items()])
+    print(f"Linhas gravadas no banco: {len(linhas)}")
+    return particoes
+
+def numeros_banco(conexao):
+    """Retorna os conjuntos de números já gravados no banco, de Sales Orders e de Quotations."""
+    numeros = {"Sales Orders": set(), "Quotations": set()}
+    for aba, numero in conexao.execute("SELECT DISTINCT aba, numero FROM modulos"):
+        numeros[aba].add(numero)
+    return numeros["Sales Orders"], numeros["Quotations"]
+
+def importar_planilha(conexao, arquivo_excel, numeros=None):
+    """
+    Carrega no banco as linhas de uma planilha existente (usado quando o banco ainda está vazio,
+    para que a exportação não perca o histórico). Com numeros ({aba: números canônicos}) só
+    entram as linhas desses números.
+    """
+    wb = load_workbook(arquivo_excel, read_only=True)
+    try:
+        dados = {}
+        for aba in ("Sales Orders", "Quotations"):
+            if aba in wb.sheetnames:
+                dados[aba] = [list(linha) for linha in wb[aba].iter_rows(min_row=2, values_only=True)
+                              if linha and linha[0] is not None
+                              and (numeros is None or canonizar_numero(linha[0]) in numeros.get(aba, ()))]
+    finally:
+        wb.close()
+    gravar_no_banco(conexao, dados.get("Sales Orders", []), dados.get("Quotations", []))
+
+def exportar_planilha(caminho_banco, caminho_destino, nome_arquivo):
+    """
+    Gera a planilha a partir do banco com o writer em streaming do openpyxl (write_only), aba por aba
+    na ordem de gravação, com as tabelas formatadas como em formatar_como_tabela. Grava ao lado e
+    troca de uma vez, com a trava da planilha obtida antes de tudo: os números que outra máquina
+    exportou para a planilha e que faltam neste banco são importados dela primeiro, para não sumirem.
+    """
+    inicio = time.time()
+    caminho_completo = os.path.join(caminho_destino, nome_arquivo)
+    with (travar_planilha(caminho_completo) if TRAVA_PLANILHA else nullcontext()):
+        conexao = abrir_banco(caminho_banco)
+        try:
+            if os.path.exists(caminho_completo):
+                ids = ler_ids_excel(caminho_completo)
+                faltando = {aba: ids.get(aba, set()) - numeros
+                            for aba, numeros in zip(("Sales Orders", "Quotations"), numeros_banco(conexao))}
+                if any(faltando.values()):
+                    print(f"Importando da planilha {sum(map(len, faltando.values()))} número(s) ausentes do banco")
+                    importar_planilha(conexao, caminho_completo, faltando)
+            total = gerar_planilha_do_banco(conexao, caminho_completo)
+        finally:
+            conexao.close()
+    print(f"Planilha exportada do banco: {total} linhas em {time.time() - inicio:.2f}s ({caminho_completo})")
+
+def gerar_planilha_do_banco(conexao, caminho_completo):
+    """
+    Escreve a planilha de exportar_planilha num temporário ao lado e troca de uma vez.
+    Retorna o total de linhas.
+    """
+    colunas = ", ".join(f'"{coluna}"' for coluna in COLUNAS_BANCO)
+    wb = Workbook(write_only=True)
+    total = 0
+    for aba, nome_tabela in (("Sales Orders", "SalesOrdersTable"), ("Quotations", "QuotationsTable")):
+        ws = wb.create_sheet(aba)
+        cabecalhos = ESQUEMA_COMPILADO.cabecalhos[aba]
+        ws.append(cabecalhos)
+        linhas = 0
+        for linha in conexao.execute(f"SELECT numero, {colunas} FROM modulos WHERE aba = ? ORDER BY id", (aba,)):
+            ws.append(linha)
+            linhas += 1
+        tabela = Table(displayName=nome_tabela, ref=f"A1:{get_column_letter(len(cabecalhos))}{linhas + 1}")
+        tabela.tableStyleInfo = TableStyleInfo(name="TableStyleMedium9", showFirstColumn=False,
+                                               showLastColumn=False, showRowStripes=True, showColumnStripes=True)
+        tabela.tableColumns = [TableColumn(id=i, name=nome) for i, nome in enumerate(cabecalhos, 1)]
+        with warnings.catch_warnings():
+            # O aviso do modo write_only pede as colunas da tabela, que já foram preenchidas acima
+            warnings.simplefilter("ignore", UserWarning)
+            ws.add_table(tabela)
+        total += linhas
+    descritor, caminho_temporario = tempfile.mkstemp(suffix=".xlsx", dir=os.path.dirname(caminho_completo))
+    os.close(descritor)
+    try:
+        wb.save(caminho_temporario)
+        os.replace(caminho_temporario, caminho_completo)
+    finally:
+        if os.path.exists(caminho_temporario):
+            os.remove(caminho_temporario)
+    return total
+
+TIPOS_COLUNARES = [coluna.colunar for coluna in ESQUEMA]
+
+def valor_colunar(tipo, valor):
+    """
+    Converte um valor da linha extraída para o tipo da coluna. 'nan', 'None' e vazios viram nulos.
+    """
+    if valor is None or str(valor).strip() in ("", "nan", "None"):
+        return None
+    if tipo == "data":
+        try:
+            return datetime.strptime(str(valor).strip(), "%d/%m/%Y").date()
+        except ValueError:
+            return None
+    if tipo == "inteiro":
+        try:
+            return int(float(valor))
+        except (ValueError, OverflowError):
+            return None
+    if tipo == "decimal":
+        try:
+            return float(valor)
+        except ValueError:
+            return None
+    return str(valor).strip()
+
+def particoes_colunares(dados):
+    """
+    Converte as linhas de uma aba para os tipos do esquema (número canônico na primeira coluna) e
+    as separa por mês de criação: {'aaaa-mm' ou 'sem_data': [linhas]}.
+    """
+    particoes = {}
+    for linha in dados:
+        valores = [canonizar_numero(linha[0])] + [valor_colunar(tipo, valor)
+                                                   for tipo, valor in zip(TIPOS_COLUNARES[1:], linha[1:])]
+        criacao = valores[INDICE_DATA_CRIACAO]
+        particoes.setdefault(criacao.strftime("%Y-%m") if criacao else "sem_data", []).append(valores)
+    return particoes
+
+def escrever_particao_colunar(aba, linhas, destino, formato):
+    """
+    Escreve as linhas de uma partição com os tipos do esquema. O arquivo é escrito com outro nome e
+    renomeado no fim, para o BI nunca ler um arquivo pela metade.
+    """
+    tipos_arrow = {"data": pa.date32(), "inteiro": pa.int64(), "decimal": pa.float64(), "texto": pa.string()}
+    colunas = list(zip(*linhas))
+    tabela = pa.table([pa.array(colunas[0], pa.string())] +
+                      [pa.array(valores, tipos_arrow[tipo]) for tipo, valores in zip(TIPOS_COLUNARES[1:], colunas[1:])],
+                      names=ESQUEMA_COMPILADO.cabecalhos[aba])
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    temporario = destino + ".tmp"
+    if formato == "feather":
+        feather.write_feather(tabela, temporario)
+    else:
+        pq.write_table(tabela, temporario)
+    os.replace(temporario, destino)
+
+def pasta_particao(diretorio, aba, mes):
+    return os.path.join(diretorio, aba.lower().replace(" ", "_"), f"mes={mes}")
+
+def gravar_colunar(sales_orders_data, quotations_data, diretorio=None, formato=None):
+    """
+    Acrescenta as linhas à saída colunar, um arquivo novo por aba e mês de criação, com o número
+    canônico na primeira coluna e os tipos declarados no esquema (inteiros, decimais, datas, texto).
+    """
+    if pa is None:
+        print("Saída colunar ignorada: instale o pyarrow (pip install pyarrow)")
+        return False
+    diretorio = diretorio or DIRETORIO_COLUNAR
+    formato = formato or FORMATO_COLUNAR
+    carimbo = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"
+    arquivos = 0
+    for aba, dados in (("Sales Orders", sales_orders_data), ("Quotations", quotations_data)):
+        for mes, linhas in particoes_colunares(dados).items():
+            destino = os.path.join(pasta_particao(diretorio, aba, mes), f"parte_{carimbo}.{formato}")
+            escrever_particao_colunar(aba, linhas, destino, formato)
+            arquivos += 1
+    print(f"Saída colunar: {arquivos} arquivo(s) {formato} em {diretorio}")
+    return True
+
+def regravar_colunar_do_banco(conexao, particoes, diretorio=None, formato=None):
+    """
+    Com o banco como registro oficial, regrava inteiras as partições (aba, mês) tocadas por uma
+    gravação a partir do banco, num único arquivo por partição que substitui os anteriores. Um
+    documento reprocessado (upsert no banco) não aparece duas vezes para o BI.
+    """
+    if pa is None:
+        print("Saída colunar ignorada: instale o pyarrow (pip install pyarrow)")
+        return False
+    diretorio = diretorio or DIRETORIO_COLUNAR
+    formato = formato or FORMATO_COLUNAR
+    colunas = ", ".join(f'"{coluna}"' for coluna in COLUNAS_BANCO)
+    for aba, mes in sorted(particoes):
+        if mes == "sem_data":
+            filtro, parametros = "data_criacao IS NULL", (aba,)
+        else:
+            filtro, parametros = "data_criacao LIKE ?", (aba, mes + "-%")
+        linhas = conexao.execute(f"SELECT numero, {colunas} FROM modulos WHERE aba = ? AND {filtro} ORDER BY id",
+                                 parametros).fetchall()
+        linhas = particoes_colunares(linhas).get(mes, [])
+        pasta = pasta_particao(diretorio, aba, mes)
+        destino = os.path.join(pasta, f"banco.{formato}")
+        if linhas:
+            escrever_particao_colunar(aba, linhas, destino, formato)
+        # Partes acrescentadas antes (ou a partição que ficou vazia) são substituídas pelo banco
+        if os.path.isdir(pasta):
+            for nome in os.listdir(pasta):
+                if nome.endswith((".parquet", ".feather")) and os.path.join(pasta, nome) != (destino if linhas else None):
+                    os.remove(os.path.join(pasta, nome))
+    print(f"Saída colunar: {len(particoes)} partição(ões) {formato} regravadas do banco em {diretorio}")
+    return True
+
+def carregar_numeros_existentes():
+    """
+    Números já gravados, de onde estiver o registro oficial: o banco (importando a planilha na
+    primeira vez) ou a coluna A da planilha.
+    """
     caminho_excel = os.path.join(DIRETORIO_DESTINO, ARQUIVO_DESTINO)
+    if BACKEND_ARMAZENAMENTO == "sqlite":
+        conexao = abrir_banco(BANCO_DADOS)
+        try:
+            if conexao.execute("SELECT 1 FROM modulos LIMIT 1").fetchone() is None and os.path.exists(caminho_excel):
+                print(f"Banco vazio: importando {caminho_excel}")
+                importar_planilha(conexao, caminho_excel)
+            return numeros_banco(conexao)
+        finally:
+            conexao.close()
     if os.path.exists(caminho_excel):
-        sales_numbers, quotations_numbers = ler_numeros_excel(caminho_excel)
-    else:
-        sales_numbers, quotations_numbers = ([], [])
-    
-    # Print dos números encontrados em cada aba (sem duplicatas)
-    print("Números na aba Sales Orders:", sales_numbers)
-    print("Números na aba Quotations:", quotations_numbers)
-    
-    if arquivos_csv:
+        return ler_numeros_excel(caminho_excel)
+    return set(), set()
+
+def verificar_gravacao(arquivo_excel, numeros_gravados):
+    """
+    Relê a coluna A das abas gravadas e confirma que todos os números esperados estão na planilha.
+    """
+    abas = [aba for aba, numeros in numeros_gravados.items() if numeros]
+    if not abas:
+        return True
+    try:
+        ids = ler_ids_excel(arquivo_excel, abas)
+    except Exception as e:
+        print(f"Erro ao verificar a planilha salva: {e}")
+        return False
+    faltando = sum(len(numeros_gravados[aba] - ids[aba]) for aba in abas)
+    if faltando:
+        print(f"Erro: {faltando} número(s) gravados não encontrados na planilha salva")
+    return not faltando
+
+def gravar_saida_colunar(sales_orders_data, quotations_data, conexao=None, particoes=None):
+    """
+    Saída adicional para o BI depois de uma gravação bem-sucedida; um erro aqui não desfaz a gravação.
+    Com a conexão do banco e as partições de gravar_no_banco, as partições são regravadas do banco.
+    """
+    if not SAIDA_COLUNAR or not (sales_orders_data or quotations_data):
+        return
+    try:
+        if conexao is not None:
+            regravar_colunar_do_banco(conexao, particoes)
+        else:
+            gravar_colunar(sales_orders_data, quotations_data)
+    except Exception as e:
+        print(f"Erro ao gravar a saída colunar: {e}")
+
+def assinatura_planilha(caminho_excel):
+    """
+    (tamanho, data de modificação em ns) da planilha, ou None se ela não existe.
+    """
+    try:
+        info = os.stat(caminho_excel)
+    except FileNotFoundError:
+        return None
+    return info.st_size, info.st_mtime_ns
+
+def salvar_e_registrar(sales_orders_data, quotations_data, entradas_registro, registro, numeros_gravados=None,
+                       planilha=None):
+    """
+    Grava as linhas na planilha (ou no banco, com BACKEND_ARMAZENAMENTO "sqlite") e depois registra
+    os arquivos. Com numeros_gravados ({aba: números})
+    e VERIFICAR_GRAVACAO, a gravação só conta depois de conferida na planilha salva. Arquivos
+    processados e duplicados só entram no registro se a planilha foi salva. Retorna True se a planilha foi salva.
+    planilha ({"assinatura": assinatura_planilha, "numeros": (sales, quotations)}, do modo contínuo)
+    mantém os números em memória como referência: com a trava, se a planilha não mudou desde a
+    última gravação desta execução, a coluna A não é relida nem antes nem depois de gravar; se
+    outra execução gravou, os números são relidos uma vez. Os números gravados entram em planilha.
+    """
+    if BACKEND_ARMAZENAMENTO == "sqlite":
+        salvo = False
+        try:
+            conexao = abrir_banco(BANCO_DADOS)
+            try:
+                particoes = gravar_no_banco(conexao, sales_orders_data, quotations_data)
+                salvo = True
+                gravar_saida_colunar(sales_orders_data, quotations_data, conexao, particoes)
+            finally:
+                conexao.close()
+        except Exception as e:
+            print(f"Erro ao gravar no banco: {e}")
+        if salvo:
+            if planilha is not None and numeros_gravados:
+                planilha["numeros"][0].update(numeros_gravados['Sales Orders'])
+                planilha["numeros"][1].update(numeros_gravados['Quotations'])
+        if registro is not None:
+            registrar_arquivos(registro, entradas_registro, salvo)
+        return salvo
+    salvar = anexar_em_excel if ESCRITA_INCREMENTAL else salvar_em_excel
+    caminho_excel = os.path.join(DIRETORIO_DESTINO, ARQUIVO_DESTINO)
+    try:
+        with (travar_planilha(caminho_excel) if TRAVA_PLANILHA else nullcontext()):
+            em_memoria = planilha is not None and TRAVA_PLANILHA
+            if em_memoria and assinatura_planilha(caminho_excel) != planilha["assinatura"]:
+                print("Planilha alterada por outra execução: relendo os números da coluna A")
+                ids = ler_ids_excel(caminho_excel) if os.path.exists(caminho_excel) else {}
+                for numeros, aba in zip(planilha["numeros"], ('Sales Orders', 'Quotations')):
+                    numeros.clear()
+                    numeros.update(ids.get(aba, ()))
+                planilha["assinatura"] = assinatura_planilha(caminho_excel)
+            if TRAVA_PLANILHA and numeros_gravados:
+                ids = {'Sales Orders': planilha["numeros"][0], 'Quotations': planilha["numeros"][1]} if em_memoria else None
+                sales_orders_data, quotations_data = descartar_ja_gravados(
+                    caminho_excel, sales_orders_data, quotations_data, entradas_registro, numeros_gravados, ids)
+            for tentativa in range(1, TENTATIVAS_GRAVACAO + 1):
+                salvo = salvar(sales_orders_data, quotations_data, DIRETORIO_DESTINO, ARQUIVO_DESTINO)
+                if salvo or tentativa == TENTATIVAS_GRAVACAO:
+                    break
+                print(f"Nova tentativa de gravação em {2 * tentativa}s ({tentativa + 1} de {TENTATIVAS_GRAVACAO})")
+                time.sleep(2 * tentativa)
+            if em_memoria:
+                # A troca do arquivo é atômica: salvo, a planilha é a anterior mais as linhas deste lote
+                planilha["assinatura"] = assinatura_planilha(caminho_excel) if salvo else None
+                if salvo and numeros_gravados:
+                    planilha["numeros"][0].update(numeros_gravados['Sales Orders'])
+                    planilha["numeros"][1].update(numeros_gravados['Quotations'])
+            elif salvo and numeros_gravados and VERIFICAR_GRAVACAO:
+                salvo = verificar_gravacao(caminho_excel, numeros_gravados)
+    except Exception as e:
+        # Trava inacessível (destino fora da rede), planilha corrompida, espera esgotada...: o lote
+        # fica sem gravar, como numa falha de salvar_em_excel
+        print(f"Erro ao salvar o arquivo Excel: {e}")
+        salvo = False
+        if planilha is not None:
+            planilha["assinatura"] = None  # Estado da planilha incerto: relê a coluna A na próxima gravação
+    if salvo:
+        gravar_saida_colunar(sales_orders_data, quotations_data)
+    if registro is not None:
+        registrar_arquivos(registro, entradas_registro, salvo)
+    return salvo
+
+def extrair_arquivo(caminho, nome, ctime, conteudo):
+    """
+    Faz o parse de um arquivo já lido e extrai as linhas dos módulos. Também roda nos processos
+    de extrair_em_paralelo, por isso recebe e devolve apenas dados simples.
+    Retorna (tipo, linhas extraídas); o tipo é None se o arquivo não pôde ser processado.
+    """
+    try:
+        customer = extrair_cliente(nome)
+        if LEITURA_STREAMING:
+            tipo, linhas, numero, data_criacao, _ = processar_csv_streaming(caminho, conteudo, ctime)
+            dados = list(extrair_dados_streaming(linhas, tipo, numero, data_criacao, customer)) if tipo else []
+        else:
+            tipo, df, numero, data_criacao, _ = processar_csv(caminho, conteudo, ctime)
+            dados = extrair_dados(df, tipo, numero, data_criacao, customer) if tipo and df is not None else []
+        return tipo, dados
+    except Exception as e:
+        print(f"Erro ao extrair os dados do arquivo {caminho}: {e}")
+        return None, []
+
+def extrair_em_sequencia(tarefas, ao_concluir=None, guardar=True):
+    """
+    Executa extrair_arquivo para cada tarefa (caminho, nome, ctime, conteúdo), na ordem.
+    ao_concluir(índice da tarefa, resultado) é chamado a cada arquivo extraído. Com guardar=False
+    os resultados só passam por ao_concluir e não ficam na lista devolvida.
+    """
+    resultados = []
+    for i, tarefa in enumerate(tarefas):
+        resultados.append(extrair_arquivo(*tarefa))
+        if ao_concluir:
+            ao_concluir(i, resultados[i])
+        if not guardar:
+            resultados[i] = None
+    return resultados
+
+def extrair_em_paralelo(tarefas, processos=None, ao_concluir=None, guardar=True):
+    """
+    Distribui as tarefas (caminho, nome, ctime, conteúdo) entre processos e devolve os resultados
+    de extrair_arquivo na mesma ordem das tarefas. As tarefas são consumidas aos poucos, com no máximo
+    dois arquivos por processo em andamento. Um arquivo com erro não interrompe os demais, e se o
+    pool cair os arquivos restantes são extraídos no processo principal.
+    ao_concluir(índice da tarefa, resultado) é chamado na ordem em que os arquivos terminam; com
+    guardar=False os resultados não ficam na lista devolvida.
+    """
+    processos = processos or os.cpu_count() or 1
+    resultados = []
+    em_andamento = {}
+
+    def coletar(futuros):
+        for futuro in futuros:
+            i, tarefa = em_andamento.pop(futuro)
+            try:
+                resultados[i] = futuro.result()
+            except BrokenProcessPool:
+                resultados[i] = extrair_arquivo(*tarefa)
+            except Exception as e:
+                print(f"Erro ao extrair os dados do arquivo {tarefa[0]}: {e}")
+                resultados[i] = (None, [])
+            if ao_concluir:
+                ao_concluir(i, resultados[i])
+            if not guardar:
+                resultados[i] = None
+
+    with ProcessPoolExecutor(max_workers=processos) as executor:
+        for i, tarefa in enumerate(tarefas):
+            resultados.append(None)
+            if len(em_andamento) >= 2 * processos:
+                concluidos, _ = wait(em_andamento, return_when=FIRST_COMPLETED)
+                coletar(concluidos)
+            try:
+                em_andamento[executor.submit(extrair_arquivo, *tarefa)] = (i, tarefa)
+            except BrokenProcessPool:
+                resultados[i] = extrair_arquivo(*tarefa)
+                if ao_concluir:
+                    ao_concluir(i, resultados[i])
+                if not guardar:
+                    resultados[i] = None
+        while em_andamento:
+            concluidos, _ = wait(em_andamento, return_when=FIRST_COMPLETED)
+            coletar(concluidos)
+    return resultados
+
+def extrair_arquivos(tarefas, quantidade, ao_concluir=None, guardar=True, processos=None):
+    """
+    Extrai as tarefas em processos (extrair_em_paralelo) se forem ao menos MINIMO_ARQUIVOS_PARALELO
+    arquivos; para um ou dois arquivos novos, subir o pool custa mais que a extração em si.
+    quantidade é o número de arquivos a ler, que limita o de tarefas.
+    """
+    if EXTRACAO_PARALELA and quantidade >= MINIMO_ARQUIVOS_PARALELO:
+        return extrair_em_paralelo(tarefas, processos or PROCESSOS_EXTRACAO, ao_concluir, guardar)
+    return extrair_em_sequencia(tarefas, ao_concluir, guardar)
+
+def criar_aba_streaming(wb, aba, nome_tabela):
+    """
+    Cria a aba num Workbook write_only com o cabeçalho e a definição da tabela já no início;
+    a referência da tabela é ajustada ao número final de linhas antes de salvar.
+    """
+    ws = wb.create_sheet(aba)
+    cabecalhos = ESQUEMA_COMPILADO.cabecalhos[aba]
+    ws.append(cabecalhos)
+    tabela = Table(displayName=nome_tabela, ref=f"A1:{get_column_letter(len(cabecalhos))}2")
+    tabela.tableStyleInfo = TableStyleInfo(name="TableStyleMedium9", showFirstColumn=False,
+                                           showLastColumn=False, showRowStripes=True, showColumnStripes=True)
+    tabela.tableColumns = [TableColumn(id=i, name=nome) for i, nome in enumerate(cabecalhos, 1)]
+    with warnings.catch_warnings():
+        # O aviso do modo write_only pede as colunas da tabela, que já foram preenchidas acima
+        warnings.simplefilter("ignore", UserWarning)
+        ws.add_table(tabela)
+    return ws, tabela
+
+def reconstruir_planilha(diretorios, caminho_destino, nome_arquivo, processos=None):
+    """
+    Refaz a planilha do zero a partir de todos os CSV de origem: lê à frente em threads, extrai em
+    processos e escreve cada arquivo assim que ele termina (na ordem de prioridade_original) num
+    Workbook write_only, sem guardar as linhas em memória. Um número repetido em outro upload fica
+    só com o primeiro nessa ordem e os outros são registrados como "repetido", como numa execução incremental. A trava da planilha fica com a
+    reconstrução do início ao fim, e a planilha nova substitui a antiga de uma vez.
+    Mostra o andamento e o total em linhas por segundo.
+    """
+    inicio = time.perf_counter()
+    caminho_completo = os.path.join(caminho_destino, nome_arquivo)
+    cache = abrir_cache(DIRETORIO_CACHE) if USAR_CACHE_LOCAL or MODO_OFFLINE else None
+    arquivos = arquivos_em_cache(cache, diretorios) if MODO_OFFLINE else descobrir_arquivos(diretorios)
+    arquivos.sort(key=prioridade_original)
+    print(f"Reconstruindo {caminho_completo} a partir de {len(arquivos)} arquivo(s)")
+    wb = Workbook(write_only=True)
+    abas = {aba: criar_aba_streaming(wb, aba, nome_tabela)
+            for aba, nome_tabela in (("Sales Orders", "SalesOrdersTable"), ("Quotations", "QuotationsTable"))}
+    linhas_por_aba = {aba: 0 for aba in abas}
+    numeros_gravados = {aba: set() for aba in abas}
+    entradas_registro = []
+    em_andamento = {}  # índice da tarefa -> (arquivo, hash, primeira célula), só até ser escrita
+    concluidas = {}  # resultados que terminaram antes de um anterior na listagem
+    proxima = 0
+    contador = itertools.count()
+
+    def tarefas():
+        for arquivo, conteudo, erro in pre_carregar_arquivos(arquivos, cache=cache):
+            if erro is not None:
+                print(f"Erro ao ler o arquivo {arquivo.caminho}: {erro}")
+                continue
+            if len(conteudo) != arquivo.tamanho:
+                print(f"Arquivo mudou desde a listagem (cópia em andamento?), fica para depois: {arquivo.caminho}")
+                continue
+            hash_conteudo = hashlib.sha1(conteudo).hexdigest()
+            primeira_celula = ler_primeira_celula(conteudo)
+            if not primeira_celula.startswith(('5', '2')):
+                entradas_registro.append((arquivo, hash_conteudo, primeira_celula, None, 0, "ignorado"))
+                continue
+            em_andamento[next(contador)] = (arquivo, hash_conteudo, primeira_celula)
+            yield arquivo.caminho, arquivo.nome, arquivo.ctime, conteudo
+
+    def escrever(i, resultado):
+        arquivo, hash_conteudo, primeira_celula = em_andamento.pop(i)
+        tipo, dados = resultado
+        if not tipo:
+            entradas_registro.append((arquivo, hash_conteudo, primeira_celula, None, 0, "erro"))
+            return
+        numero = canonizar_numero(primeira_celula)
+        if numero in numeros_gravados[tipo]:
+            entradas_registro.append((arquivo, hash_conteudo, primeira_celula, tipo, 0, "repetido"))
+            return
+        numeros_gravados[tipo].add(numero)
+        ws, _ = abas[tipo]
+        for linha in dados:
+            ws.append([numero] + list(linha[1:]))
+        linhas_por_aba[tipo] += len(dados)
+        entradas_registro.append((arquivo, hash_conteudo, primeira_celula, tipo, len(dados), "processado"))
+
+    def arquivo_concluido(i, resultado):
+        nonlocal proxima
+        concluidas[i] = resultado
+        while proxima in concluidas:
+            escrever(proxima, concluidas.pop(proxima))
+            proxima += 1
+            if proxima % 100 == 0:
+                linhas = sum(linhas_por_aba.values())
+                print(f"  {proxima} arquivos, {linhas} linhas ({linhas / (time.perf_counter() - inicio):.0f} linhas/s)")
+
+    with (travar_planilha(caminho_completo) if TRAVA_PLANILHA else nullcontext()):
+        extrair_arquivos(tarefas(), len(arquivos), arquivo_concluido, guardar=False, processos=processos)
+        for aba, (ws, tabela) in abas.items():
+            # Uma tabela precisa de ao menos uma linha de dados; sem linhas fica uma linha vazia
+            tabela.ref = f"A1:{get_column_letter(len(ESQUEMA_COMPILADO.cabecalhos[aba]))}{max(linhas_por_aba[aba], 1) + 1}"
+        descritor, caminho_temporario = tempfile.mkstemp(suffix=".xlsx", dir=caminho_destino)
+        os.close(descritor)
+        try:
+            wb.save(caminho_temporario)
+            os.replace(caminho_temporario, caminho_completo)
+        finally:
+            if os.path.exists(caminho_temporario):
+                os.remove(caminho_temporario)
+    if cache is not None:
+        cache.conexao.close()
+    if USAR_REGISTRO:
+        registro = abrir_registro(ARQUIVO_REGISTRO)
+        registrar_arquivos(registro, entradas_registro)
+        registro.close()
+    duracao = time.perf_counter() - inicio
+    linhas = sum(linhas_por_aba.values())
+    print(f"Reconstrução concluída: {len(arquivos)} arquivos, Sales Orders {linhas_por_aba['Sales Orders']}, "
+          f"Quotations {linhas_por_aba['Quotations']} linhas em {duracao:.2f}s ({linhas / duracao:.0f} linhas/s)")
+
+ETAPAS_PIPELINE = ("descobrir", "ler", "extrair", "escrever")
+
+async def executar_pipeline_async(diretorios, ao_concluir_arquivo=None):
+    """
+    Executa descobrir -> ler -> extrair -> escrever como etapas concorrentes ligadas por filas
+    limitadas (TAMANHO_FILAS). Leitura e gravação rodam em threads, e a extração em processos
+    (numa thread enquanto forem menos de MINIMO_ARQUIVOS_PARALELO). A gravação é feita em lotes de
+    até TAMANHO_LOTE arquivos enquanto as outras etapas seguem.
+    ao_concluir_arquivo(lidos, total) é chamado a cada arquivo concluído, com o total de arquivos
+    não registrados encontrados na listagem.
+    Cada extração é anotada no diário, como em processar_arquivos, e o lote é fechado nele antes
+    da gravação; o diário deixado por uma execução anterior é regravado antes de tudo.
+    Os arquivos entram na ordem de prioridade_original e, mesmo lidos em paralelo, decidem conteúdo
+    repetido e número repetido nessa ordem, como em processar_arquivos.
+    Retorna as métricas de cada etapa (itens, tempo ativo, utilização, paralelismo, vazão e fila de entrada).
+    """
+    loop = asyncio.get_running_loop()
+    inicio = time.perf_counter()
+    metricas = {etapa: {"itens": 0, "ocupado": 0.0, "ativo": 0.0, "em_uso": 0, "ativo_desde": 0.0,
+                        "fila_max": 0, "fila_soma": 0, "amostras": 0}
+                for etapa in ETAPAS_PIPELINE}
+    filas = {etapa: asyncio.Queue(TAMANHO_FILAS) for etapa in ETAPAS_PIPELINE[1:]}
+    leitores = LEITORES_PREFETCH
+    extratores = PROCESSOS_EXTRACAO or os.cpu_count() or 1
+    registro = abrir_registro(ARQUIVO_REGISTRO) if USAR_REGISTRO else None
+    concluidos = carregar_registro(registro) if registro is not None else {}
+    cache_hashes, hashes_vistos = carregar_hashes(registro) if registro is not None else ({}, {})
+    cache = abrir_cache(DIRETORIO_CACHE) if USAR_CACHE_LOCAL or MODO_OFFLINE else None
+    entradas_registro = []
+    duplicados = []
+    numeros = None
+    executor_cpu = None
+    a_extrair = 0
+    encontrados = 0
+    lidos = 0
+    bytes_extraidos = 0
+    anotados = 0
+    todos_salvos = True
+    numeros_da_execucao = {'Sales Orders': set(), 'Quotations': set()}
+    vez = asyncio.Condition()
+    proxima_vez = 0
+    diario, retomados = preparar_diario()
+    # Os arquivos do diário são regravados dele, não lidos de novo
+    no_diario = {(entrada[0].caminho, entrada[0].tamanho, entrada[0].mtime) for entrada, _, _ in retomados}
+
+    def iniciar(etapa):
+        # O tempo ativo da etapa é o de relógio com ao menos um trabalhador ocupado, não a soma deles
+        dados = metricas[etapa]
+        agora = time.perf_counter()
+        if dados["em_uso"] == 0:
+            dados["ativo_desde"] = agora
+        dados["em_uso"] += 1
+        return agora
+
+    def medir(etapa, desde, itens=1):
+        dados = metricas[etapa]
+        agora = time.perf_counter()
+        dados["itens"] += itens
+        dados["ocupado"] += agora - desde
+        dados["em_uso"] -= 1
+        if dados["em_uso"] == 0:
+            dados["ativo"] += agora - dados["ativo_desde"]
+
+    def arquivo_concluido():
+        nonlocal lidos
+        lidos += 1
+        if ao_concluir_arquivo:
+            ao_concluir_arquivo(lidos, encontrados)
+
+    def obter_numeros():
+        # A planilha só é lida quando aparece o primeiro arquivo ainda não registrado
+        nonlocal numeros
+        if numeros is None:
+            numeros = loop.run_in_executor(executor_io, carregar_numeros_existentes)
+        return numeros
+
+    async def descobrir():
+        nonlocal encontrados
+
+        async def um_diretorio(diretorio):
+            desde = iniciar("descobrir")
+            if MODO_OFFLINE:
+                arquivos = arquivos_em_cache(cache, [diretorio])
+            else:
+                arquivos = await loop.run_in_executor(executor_io, listar_diretorio, diretorio)
+            medir("descobrir", desde, len(arquivos))
+            return arquivos
+
+        listagens = await asyncio.gather(*(um_diretorio(diretorio) for diretorio in diretorios))
+        arquivos = sorted((arquivo for listagem in listagens for arquivo in listagem
+                           if not arquivo_registrado(concluidos, arquivo)
+                           and (arquivo.caminho, arquivo.tamanho, arquivo.mtime) not in no_diario),
+                          key=prioridade_original)
+        encontrados = len(arquivos)
+        for posicao, arquivo in enumerate(arquivos):
+            await filas["ler"].put((posicao, arquivo))
+        for _ in range(leitores):
+            await filas["ler"].put(None)
+
+    async def esperar_vez(posicao):
+        # Os leitores leem em paralelo, mas decidem original e número na ordem da fila
+        async with vez:
+            await vez.wait_for(lambda: proxima_vez == posicao)
+
+    async def passar_vez():
+        nonlocal proxima_vez
+        async with vez:
+            proxima_vez += 1
+            vez.notify_all()
+
+    def duplicado(arquivo, hash_conteudo, pelo_cache):
+        # Mesma regra de processar_arquivos: o primeiro caminho com o conteúdo é o original. Antes da
+        # vez do arquivo, um original já visto só pode ser de um arquivo anterior na fila
+        original = hashes_vistos.setdefault(hash_conteudo, arquivo.caminho)
+        if not USAR_DEDUPLICACAO or original == arquivo.caminho:
+            return False
+        duplicados.append((arquivo, original, pelo_cache))
+        entradas_registro.append((arquivo, hash_conteudo, None, None, 0, "duplicado"))
+        arquivo_concluido()
+        return True
+
+    async def ler_arquivo(i, arquivo):
+        hash_cache = hash_em_cache(cache_hashes, arquivo)
+        if hash_cache is not None and hashes_vistos.get(hash_cache, arquivo.caminho) != arquivo.caminho \
+                and duplicado(arquivo, hash_cache, True):
+            return
+        desde = iniciar("ler")
+        try:
+            conteudo = await loop.run_in_executor(executor_io, ler_origem, arquivo, cache)
+            if len(conteudo) != arquivo.tamanho:
+                print(f"Arquivo mudou desde a listagem (cópia em andamento?), fica para depois: {arquivo.caminho}")
+                return
+            hash_conteudo = hash_cache or hashlib.sha1(conteudo).hexdigest()
+        except Exception as e:
+            print(f"Erro ao ler o arquivo {arquivo.caminho}: {e}")
+            return
+        finally:
+            medir("ler", desde)
+        await esperar_vez(i)
+        if duplicado(arquivo, hash_conteudo, False):
+            return
+        sales_numbers, quotations_numbers = await obter_numeros()
+        try:
+            hash_conteudo, primeira_celula, tipo_arquivo, situacao = classificar_arquivo(
+                conteudo, sales_numbers, quotations_numbers, hash_conteudo)
+        except Exception as e:
+            print(f"Erro ao ler o arquivo {arquivo.caminho}: {e}")
+            return
+        if situacao != "novo":
+            entradas_registro.append((arquivo, hash_conteudo, primeira_celula, tipo_arquivo, 0, situacao))
+            arquivo_concluido()
+            return
+        numero = canonizar_numero(primeira_celula)
+        if numero in numeros_da_execucao[tipo_arquivo]:
+            print(f"Número {primeira_celula} já veio de outro arquivo desta execução")
+            entradas_registro.append((arquivo, hash_conteudo, primeira_celula, tipo_arquivo, 0, "repetido"))
+            arquivo_concluido()
+            return
+        numeros_da_execucao[tipo_arquivo].add(numero)
+        await filas["extrair"].put((i, arquivo, hash_conteudo, primeira_celula, tipo_arquivo, conteudo))
+
+    async def ler():
+        while (item := await filas["ler"].get()) is not None:
+            i, arquivo = item
+            try:
+                await ler_arquivo(i, arquivo)
+            finally:
+                # Mesmo com erro a vez passa adiante, senão os arquivos seguintes ficariam esperando
+                await esperar_vez(i)
+                await passar_vez()
+
+    def executor_extracao():
+        # Os primeiros arquivos são extraídos numa thread; o pool de processos só sobe quando
+        # chegam MINIMO_ARQUIVOS_PARALELO arquivos para extrair
+        nonlocal executor_cpu, a_extrair
+        a_extrair += 1
+        if not EXTRACAO_PARALELA or a_extrair < MINIMO_ARQUIVOS_PARALELO:
+            return executor_io
+        if executor_cpu is None:
+            executor_cpu = ProcessPoolExecutor(max_workers=extratores)
+        return executor_cpu
+
+    async def extrair():
+        nonlocal bytes_extraidos, anotados
+        while (item := await filas["extrair"].get()) is not None:
+            i, arquivo, hash_conteudo, primeira_celula, tipo_arquivo, conteudo = item
+            bytes_extraidos += len(conteudo)
+            desde = iniciar("extrair")
+            try:
+                tipo, dados = await loop.run_in_executor(
+                    executor_extracao(), extrair_arquivo, arquivo.caminho, arquivo.nome, arquivo.ctime, conteudo)
+            except Exception as e:
+                print(f"Erro ao extrair os dados do arquivo {arquivo.caminho}: {e}")
+                tipo, dados = None, []
+            medir("extrair", desde)
+            anotar_no_diario(diario, (arquivo, hash_conteudo, primeira_celula, tipo_arquivo, len(dados),
+                                      "processado" if tipo else "erro"), tipo, dados)
+            anotados += 1
+            if anotados % CHECKPOINT_ARQUIVOS == 0:
+                confirmar_diario(diario)
+            arquivo_concluido()
+            await filas["escrever"].put((i, arquivo, hash_conteudo, primeira_celula, tipo_arquivo, tipo, dados))
+
+    async def gravar_lote(lote):
+        nonlocal todos_salvos
+        desde = iniciar("escrever")
+        # Mesma ordem da listagem dentro do lote, independente de qual arquivo terminou primeiro
+        lote.sort(key=lambda item: item[0])
         sales_orders_data = []
         quotations_data = []
-        descricao.set("Processando arquivos CSV...")
-        root.update()
-        arquivos_lidos = 0
+        numeros_gravados = {'Sales Orders': set(), 'Quotations': set()}
+        entradas_lote = []
+        for _, arquivo, hash_conteudo, primeira_celula, tipo_arquivo, tipo, dados in lote:
+            if tipo == 'Sales Orders':
+                sales_orders_data.extend(dados)
+            elif tipo == 'Quotations':
+                quotations_data.extend(dados)
+            if tipo:
+                numeros_gravados[tipo].add(canonizar_numero(primeira_celula))
+            status = "processado" if tipo else "erro"
+            entradas_lote.append((arquivo, hash_conteudo, primeira_celula, tipo_arquivo, len(dados), status))
+        # Extrações ainda na fila também ficam antes do marcador: estão completas e são regravadas
+        # numa próxima execução se alguma gravação falhar
+        fechar_lote_diario(diario)
+        # Trava, gravação e conferência numa thread; o registro SQLite é usado só na thread do loop
+        salvo = await loop.run_in_executor(executor_io, salvar_e_registrar, sales_orders_data, quotations_data,
+                                           entradas_lote, None, numeros_gravados)
+        if salvo:
+            # Um número gravado neste lote passa a 'existente' para os arquivos lidos depois
+            sales_numbers, quotations_numbers = await obter_numeros()
+            sales_numbers.update(numeros_gravados['Sales Orders'])
+            quotations_numbers.update(numeros_gravados['Quotations'])
+        todos_salvos = todos_salvos and salvo
+        if registro is not None:
+            registrar_arquivos(registro, entradas_lote, salvo)
+        medir("escrever", desde, len(lote))
+
+    async def escrever():
+        lote = []
+        while (item := await filas["escrever"].get()) is not None:
+            lote.append(item)
+            if len(lote) >= TAMANHO_LOTE:
+                await gravar_lote(lote)
+                lote = []
+        if lote:
+            await gravar_lote(lote)
+
+    async def amostrar_filas():
+        while True:
+            for etapa, fila in filas.items():
+                metricas[etapa]["fila_max"] = max(metricas[etapa]["fila_max"], fila.qsize())
+                metricas[etapa]["fila_soma"] += fila.qsize()
+                metricas[etapa]["amostras"] += 1
+            await asyncio.sleep(0.1)
+
+    async def encerrar(tarefas, proxima, quantidade):
+        await asyncio.gather(*tarefas)
+        for _ in range(quantidade):
+            await filas[proxima].put(None)
+
+    async def regravar_diario():
+        nonlocal todos_salvos
+        sales_numbers, quotations_numbers = await obter_numeros()
+        resultado = processar_arquivos([], sales_numbers, quotations_numbers, registro, cache,
+                                       (cache_hashes, hashes_vistos), diario=diario, retomados=retomados)
+        if resultado.salvo:
+            sales_numbers.update(resultado.numeros['Sales Orders'])
+            quotations_numbers.update(resultado.numeros['Quotations'])
+        todos_salvos = resultado.salvo
+        for aba, numeros_regravados in resultado.numeros.items():
+            numeros_da_execucao[aba].update(numeros_regravados)
+
+    concluido = False
+    with ThreadPoolExecutor(max_workers=leitores + 1) as executor_io:
+        amostragem = asyncio.create_task(amostrar_filas())
+        try:
+            if retomados:
+                await regravar_diario()
+            await asyncio.gather(
+                descobrir(),
+                encerrar([asyncio.create_task(ler()) for _ in range(leitores)], "extrair", extratores),
+                encerrar([asyncio.create_task(extrair()) for _ in range(extratores)], "escrever", 1),
+                escrever(),
+            )
+            if duplicados:
+                imprimir_duplicados(duplicados, bytes_extraidos, metricas["extrair"]["ativo"])
+            if registro is not None:
+                # O original de um duplicado pode estar num lote que não foi gravado
+                registrar_arquivos(registro, entradas_registro, todos_salvos)
+            concluido = True
+        finally:
+            amostragem.cancel()
+            encerrar_diario(diario, concluido and todos_salvos)
+            if executor_cpu is not None:
+                executor_cpu.shutdown()
+            if registro is not None:
+                registro.close()
+            if cache is not None:
+                cache.conexao.close()
+    duracao = time.perf_counter() - inicio
+    for etapa, dados_etapa in metricas.items():
+        dados_etapa["vazao"] = dados_etapa["itens"] / duracao if duracao else 0.0
+        dados_etapa["utilizacao"] = dados_etapa["ativo"] / duracao if duracao else 0.0
+        dados_etapa["paralelismo"] = dados_etapa["ocupado"] / dados_etapa["ativo"] if dados_etapa["ativo"] else 0.0
+        dados_etapa["fila_media"] = dados_etapa["fila_soma"] / dados_etapa["amostras"] if dados_etapa["amostras"] else 0.0
+    return metricas
+
+def imprimir_metricas_pipeline(metricas):
+    """
+    Mostra por etapa os itens, o tempo ativo (de relógio, com ao menos um trabalhador ocupado), a
+    utilização sobre a execução toda, o paralelismo médio enquanto ativa, a vazão e a fila de entrada.
+    A etapa mais perto de 100% de utilização é o gargalo do dia.
+    """
+    print(f"{'Etapa':<10} {'Itens':>7} {'Ativo':>9} {'Utiliz.':>8} {'Paralel.':>9} {'Itens/s':>9} "
+          f"{'Fila máx':>9} {'Fila média':>11}")
+    for etapa, dados in metricas.items():
+        print(f"{etapa:<10} {dados['itens']:>7} {dados['ativo']:>8.2f}s {dados['utilizacao']:>7.0%} "
+              f"{dados['paralelismo']:>9.1f} {dados['vazao']:>9.1f} {dados['fila_max']:>9} {dados['fila_media']:>11.1f}")
+
+def imprimir_duplicados(duplicados, bytes_extraidos, duracao_extracao):
+    """
+    Lista os arquivos descartados por conteúdo repetido, com os bytes que deixaram de ser processados
+    e o tempo economizado estimado pela vazão de leitura + extração desta execução.
+    """
+    bytes_duplicados = sum(arquivo.tamanho for arquivo, _, _ in duplicados)
+    sem_leitura = sum(1 for _, _, pelo_cache in duplicados if pelo_cache)
+    for arquivo, original, pelo_cache in duplicados:
+        print(f"Duplicado{' (cache)' if pelo_cache else ''}: {arquivo.nome} = {original}")
+    if bytes_extraidos:
+        economia = f"{bytes_duplicados * duracao_extracao / bytes_extraidos:.2f}s"
+    else:
+        economia = "n/d (nenhum arquivo extraído nesta execução)"
+    print(f"Duplicados ignorados: {len(duplicados)} ({sem_leitura} sem leitura), "
+          f"{bytes_duplicados / 1024:.1f} KB, tempo economizado estimado: {economia}")
+
+def anotar_no_diario(diario, entrada, tipo=None, dados=()):
+    """
+    Acrescenta ao diário uma linha JSON com a entrada do registro (arquivo, hash, número, aba,
+    linhas, status) e as linhas extraídas do arquivo.
+    """
+    arquivo, hash_conteudo, numero, tipo_arquivo, linhas, status = entrada
+    diario.write(json.dumps({
+        "arquivo": list(arquivo), "hash": hash_conteudo, "numero": numero, "tipo_arquivo": tipo_arquivo,
+        "linhas": linhas, "status": status, "tipo": tipo, "dados": dados,
+    }, ensure_ascii=False) + "\n")
+
+def confirmar_diario(diario):
+    """Garante no disco o que já foi escrito no diário (checkpoint)."""
+    diario.flush()
+    os.fsync(diario.fileno())
+
+def fechar_lote_diario(diario):
+    """
+    Marca no diário que a extração do lote terminou: daqui em diante só falta gravar a planilha,
+    e uma próxima execução reaproveita o lote mesmo sem --retomar.
+    """
+    diario.write(json.dumps({"lote_completo": True}) + "\n")
+    confirmar_diario(diario)
+
+def ler_diario(caminho_diario):
+    """
+    Lê o diário deixado por uma execução anterior. Retorna a lista de (entrada do registro, tipo, dados)
+    e quantos dos primeiros registros vêm antes do último lote fechado (extração completa, só a
+    gravação falhou). Uma última linha cortada pela interrupção é ignorada.
+    """
+    registros = []
+    fechados = 0
+    with open(caminho_diario, encoding="utf-8") as diario:
+        for linha in diario:
+            try:
+                item = json.loads(linha)
+            except ValueError:
+                break
+            if item.get("lote_completo"):
+                fechados = len(registros)
+                continue
+            entrada = (ArquivoOrigem(*item["arquivo"]), item["hash"], item["numero"], item["tipo_arquivo"],
+                       item["linhas"], item["status"])
+            registros.append((entrada, item["tipo"], item["dados"]))
+    return registros, fechados
+
+def preparar_diario():
+    """
+    Trata o diário deixado por uma execução anterior. Um lote fechado (a extração terminou e a
+    gravação falhou) é sempre reaproveitado, e a recuperação custa só a gravação. O que foi anotado
+    depois do último fechamento (extração interrompida no meio) é reaproveitado com RETOMAR_EXECUCAO
+    e descartado sem. Retorna o arquivo aberto para a execução atual e os registros retomados.
+    """
+    retomados = []
+    if os.path.exists(DIARIO_EXTRACAO):
+        registros, fechados = ler_diario(DIARIO_EXTRACAO)
+        abertos = len(registros) - fechados
+        if fechados:
+            print(f"Regravando lote extraído e não gravado: {fechados} arquivo(s) no diário")
+        if RETOMAR_EXECUCAO:
+            retomados = registros
+            if abertos:
+                print(f"Retomando execução interrompida: {abertos} arquivo(s) no diário")
+        else:
+            retomados = registros[:fechados]
+            if abertos:
+                print("Extração interrompida descartada do diário (use --retomar para aproveitá-la)")
+        # Reescreve o diário só com o que será reaproveitado. O lote fechado continua marcado, para
+        # que uma nova interrupção antes da gravação não o descarte
+        with open(DIARIO_EXTRACAO, "w", encoding="utf-8") as diario:
+            for posicao, (entrada, tipo, dados) in enumerate(retomados):
+                if fechados and posicao == fechados:
+                    fechar_lote_diario(diario)
+                anotar_no_diario(diario, entrada, tipo, dados)
+            if fechados and len(retomados) == fechados:
+                fechar_lote_diario(diario)
+            confirmar_diario(diario)
+    return open(DIARIO_EXTRACAO, "a", encoding="utf-8"), retomados
+
+def encerrar_diario(diario, salvo):
+    """
+    Fecha o diário e o apaga se a planilha foi salva e registrada; senão ele fica para --retomar.
+    """
+    diario.close()
+    if salvo:
+        os.remove(diario.name)
+
+ResultadoLote = namedtuple("ResultadoLote", ["salvo", "extraidos", "linhas", "numeros", "incompletos"])
+
+def processar_arquivos(arquivos_csv, sales_numbers, quotations_numbers, registro=None, cache=None,
+                       hashes=None, ao_concluir_arquivo=None, ao_salvar=None, diario=None, retomados=(),
+                       planilha=None):
+    """
+    Lê, classifica, extrai e grava na planilha uma lista de ArquivoOrigem já filtrada pelo registro,
+    e registra o resultado de cada arquivo. hashes é o par de carregar_hashes (carregado do registro
+    se omitido); o dicionário de hashes vistos é atualizado, para quem chama em lotes.
+    ao_concluir_arquivo(lidos, total) é chamado a cada extração e ao_salvar() antes da gravação.
+    Com um diario (preparar_diario), cada arquivo concluído é anotado nele, com checkpoint a cada
+    CHECKPOINT_ARQUIVOS; os retomados de um diário anterior entram sem serem lidos de novo.
+    planilha vai para salvar_e_registrar (números em memória do modo contínuo).
+    Os arquivos seguem prioridade_original, então o original de um conteúdo repetido e o arquivo que
+    fica com um número que aparece em mais de um arquivo do lote são o upload sem sufixo mais antigo.
+    Um arquivo cujo conteúdo não tem o tamanho da listagem ainda está sendo copiado: fica fora do
+    lote e do registro.
+    Retorna ResultadoLote(salvo, arquivos extraídos, linhas, {aba: números gravados}, arquivos incompletos).
+    """
+    entradas_registro = []
+    duplicados = []
+    sales_orders_data = []
+    quotations_data = []
+    numeros_gravados = {'Sales Orders': set(), 'Quotations': set()}
+    anotados = 0
+
+    def anotar(entrada, tipo=None, dados=()):
+        nonlocal anotados
+        entradas_registro.append(entrada)
+        if diario is not None:
+            anotar_no_diario(diario, entrada, tipo, dados)
+            anotados += 1
+            if anotados % CHECKPOINT_ARQUIVOS == 0:
+                confirmar_diario(diario)
+
+    def acumular(entrada, tipo, dados):
+        numero = canonizar_numero(entrada[2]) if tipo else None
+        if tipo == 'Sales Orders':
+            sales_orders_data.extend(dados)
+        elif tipo == 'Quotations':
+            quotations_data.extend(dados)
+        if tipo:
+            numeros_gravados[tipo].add(numero)
+
+    # Arquivos do diário: as linhas já extraídas entram direto, salvo se o número já chegou à
+    # planilha (interrupção entre a gravação e o registro)
+    ja_retomados = set()
+    for entrada, tipo, dados in retomados:
+        arquivo = entrada[0]
+        if (arquivo.caminho, arquivo.tamanho, arquivo.mtime) in ja_retomados:
+            continue  # Anotado de novo numa nova tentativa do mesmo lote
+        ja_retomados.add((arquivo.caminho, arquivo.tamanho, arquivo.mtime))
+        if tipo and canonizar_numero(entrada[2]) in (sales_numbers if tipo == 'Sales Orders' else quotations_numbers):
+            entrada, tipo, dados = entrada[:4] + (0, "existente"), None, []
+        acumular(entrada, tipo, dados)
+        entradas_registro.append(entrada)  # Já está no diário, reescrito por preparar_diario
+    arquivos_csv = sorted((arquivo for arquivo in arquivos_csv
+                           if (arquivo.caminho, arquivo.tamanho, arquivo.mtime) not in ja_retomados),
+                          key=prioridade_original)
+
+    # Um caminho já lido com o mesmo tamanho e data tem o hash no cache: se for cópia de um conteúdo
+    # confirmado, sai sem ser lido de novo
+    if hashes is None:
+        hashes = carregar_hashes(registro) if registro is not None else ({}, {})
+    cache_hashes, hashes_vistos = hashes
+    hashes_do_lote = []  # Originais deste lote, que só valem depois da gravação
+
+    def ver_original(hash_conteudo, caminho):
+        if hash_conteudo not in hashes_vistos:
+            hashes_vistos[hash_conteudo] = caminho
+            hashes_do_lote.append(hash_conteudo)
+        return hashes_vistos[hash_conteudo]
+
+    for entrada, _, _ in retomados:
+        if entrada[1] is not None:
+            ver_original(entrada[1], entrada[0].caminho)
+    if USAR_DEDUPLICACAO and cache_hashes:
+        a_ler = []
         for arquivo in arquivos_csv:
+            hash_conteudo = hash_em_cache(cache_hashes, arquivo)
+            original = hashes_vistos.get(hash_conteudo) if hash_conteudo is not None else None
+            if original is not None and original != arquivo.caminho:
+                duplicados.append((arquivo, original, True))
+                anotar((arquivo, hash_conteudo, None, None, 0, "duplicado"))
+            else:
+                a_ler.append(arquivo)
+        arquivos_csv = a_ler
+
+    if arquivos_csv and CLASSIFICAR_PELO_NOME:
+        classificacao = classificar_pelo_nome(arquivos_csv, sales_numbers, quotations_numbers)
+        a_ler = []
+        for arquivo in arquivos_csv:
+            numero, tipo_arquivo, situacao = classificacao.get(arquivo.caminho, (None, None, None))
+            if situacao == "existente":
+                anotar((arquivo, None, numero, tipo_arquivo, 0, "existente"))
+            else:
+                a_ler.append(arquivo)
+        print(f"Arquivos já na planilha pelo nome: {len(arquivos_csv) - len(a_ler)} de {len(arquivos_csv)}")
+        arquivos_csv = a_ler
+
+    if not arquivos_csv and not (sales_orders_data or quotations_data):
+        print("Nenhum arquivo CSV novo nos diretórios de origem.")
+        if duplicados:
+            imprimir_duplicados(duplicados, 0, 0.0)
+        if registro is not None and entradas_registro:
+            registrar_arquivos(registro, entradas_registro)
+        return ResultadoLote(True, 0, 0, numeros_gravados, [])
+
+    candidatos = []
+    incompletos = []
+    arquivos_lidos = 0
+    numeros_do_lote = {aba: set(numeros) for aba, numeros in numeros_gravados.items()}  # Com os retomados
+
+    def tarefas_extracao():
+        # Lê cada arquivo uma única vez (em threads, à frente da extração) e só repassa os números novos
+        for arquivo, conteudo, erro in pre_carregar_arquivos(arquivos_csv, cache=cache):
             try:
-                # Ler somente a primeira linha para extrair o número
-                with open(arquivo, "r", encoding="latin1") as f:
-                    primeira_linha = f.readline()
-                primeira_celula = primeira_linha.split(";")[0].strip()
-                if primeira_celula.startswith('5'):
-                    tipo_arquivo = 'Sales Orders'
-                elif primeira_celula.startswith('2'):
-                    tipo_arquivo = 'Quotations'
-                else:
+                if erro is not None:
+                    raise erro
+                if len(conteudo) != arquivo.tamanho:
+                    print(f"Arquivo mudou desde a listagem (cópia em andamento?), fica para depois: {arquivo.caminho}")
+                    incompletos.append(arquivo)
                     continue
-
-                # Print informando qual número está sendo procurado
-                print(f"Procurando {tipo_arquivo} {primeira_celula}")
-                
-                # Verificar se o número já existe no Excel
-                if (tipo_arquivo == 'Sales Orders' and primeira_celula in sales_numbers) or \
-                   (tipo_arquivo == 'Quotations' and primeira_celula in quotations_numbers):
-                    print(f"Correspondência encontrada para o número {primeira_celula}")
+                hash_conteudo = hash_em_cache(cache_hashes, arquivo) or hashlib.sha1(conteudo).hexdigest()
+                original = ver_original(hash_conteudo, arquivo.caminho)
+                if USAR_DEDUPLICACAO and original != arquivo.caminho:
+                    duplicados.append((arquivo, original, False))
+                    anotar((arquivo, hash_conteudo, None, None, 0, "duplicado"))
                     continue
-                else:
-                    print(f"Nenhuma correspondência encontrada para o número {primeira_celula}. Processando arquivo...")
-                    
-                customer = extrair_cliente(os.path.basename(arquivo))
-                tipo, df, numero, data_criacao, _ = processar_csv(arquivo)
-                if tipo and df is not None:
-                    dados = extrair_dados(df, tipo, numero, data_criacao, customer)
-                    if tipo == 'Sales Orders':
-                        sales_orders_data.extend(dados)
-                    elif tipo == 'Quotations':
-                        quotations_data.extend(dados)
-                arquivos_lidos += 1
-                atualizar_barra_progresso(progress, 2, total_passos, descricao, log, arquivos_lidos, len(arquivos_csv), inicio)
+                hash_conteudo, primeira_celula, tipo_arquivo, situacao = classificar_arquivo(
+                    conteudo, sales_numbers, quotations_numbers, hash_conteudo)
+                if situacao != "novo":
+                    anotar((arquivo, hash_conteudo, primeira_celula, tipo_arquivo, 0, situacao))
+                    continue
+                numero = canonizar_numero(primeira_celula)
+                if numero in numeros_do_lote[tipo_arquivo]:
+                    print(f"Número {primeira_celula} já veio de outro arquivo deste lote")
+                    anotar((arquivo, hash_conteudo, primeira_celula, tipo_arquivo, 0, "repetido"))
+                    continue
+                numeros_do_lote[tipo_arquivo].add(numero)
+                candidatos.append((arquivo, hash_conteudo, primeira_celula, tipo_arquivo))
+                yield arquivo.caminho, arquivo.nome, arquivo.ctime, conteudo
             except Exception as e:
-                print(f"Erro ao ler o arquivo {arquivo}: {e}")
-        descricao.set("Salvando em Excel...")
+                print(f"Erro ao ler o arquivo {arquivo.caminho}: {e}")
+
+    def arquivo_concluido(i, resultado):
+        nonlocal arquivos_lidos
+        arquivos_lidos += 1
+        if diario is not None:
+            arquivo, hash_conteudo, primeira_celula, tipo_arquivo = candidatos[i]
+            tipo, dados = resultado
+            anotar_no_diario(diario, (arquivo, hash_conteudo, primeira_celula, tipo_arquivo, len(dados),
+                                      "processado" if tipo else "erro"), tipo, dados)
+            if arquivos_lidos % CHECKPOINT_ARQUIVOS == 0:
+                confirmar_diario(diario)
+        if ao_concluir_arquivo:
+            ao_concluir_arquivo(arquivos_lidos, len(arquivos_csv))
+
+    inicio_extracao = time.perf_counter()
+    resultados = extrair_arquivos(tarefas_extracao(), len(arquivos_csv), arquivo_concluido)
+    duracao_extracao = time.perf_counter() - inicio_extracao
+    if duplicados:
+        imprimir_duplicados(duplicados, sum(arquivo.tamanho for arquivo, _, _, _ in candidatos), duracao_extracao)
+    for (arquivo, hash_conteudo, primeira_celula, tipo_arquivo), (tipo, dados) in zip(candidatos, resultados):
+        entrada = (arquivo, hash_conteudo, primeira_celula, tipo_arquivo, len(dados), "processado" if tipo else "erro")
+        acumular(entrada, tipo, dados)
+        entradas_registro.append(entrada)  # Já anotada no diário em arquivo_concluido
+    if diario is not None:
+        fechar_lote_diario(diario)
+    if ao_salvar:
+        ao_salvar()
+    salvo = salvar_e_registrar(sales_orders_data, quotations_data, entradas_registro, registro, numeros_gravados,
+                               planilha)
+    if not salvo:
+        # Conteúdos que não chegaram à planilha deixam de servir de original para os próximos lotes
+        for hash_conteudo in hashes_do_lote:
+            hashes_vistos.pop(hash_conteudo, None)
+    return ResultadoLote(salvo, len(candidatos), len(sales_orders_data) + len(quotations_data), numeros_gravados,
+                         incompletos)
+
+def observar_diretorios(diretorios, intervalo=None, espera=None, tamanho_lote=None, ciclos=None):
+    """
+    Modo contínuo: a cada intervalo verifica os diretórios de origem e grava na planilha, em lotes de
+    até tamanho_lote, os arquivos novos vistos em duas varreduras seguidas com o mesmo tamanho e data e
+    estáveis há espera segundos (os que ainda estão sendo copiados esperam a próxima varredura; uma
+    cópia do Windows mantém a data da origem, então a data antiga não basta). Só relista um diretório se a data
+    dele mudou ou se há arquivos aguardando nele. Os números da planilha são lidos uma vez e ficam em
+    memória como referência (salvar_e_registrar com planilha): a coluna A só é relida se outra execução
+    gravar, então cada lote custa só os seus arquivos mais a cópia do zip da planilha.
+    Um lote cuja gravação falhou fica no diário e é regravado no lote seguinte sem ser extraído de novo.
+    ciclos limita o número de varreduras (None = até Ctrl+C).
+    """
+    intervalo = INTERVALO_OBSERVACAO if intervalo is None else intervalo
+    espera = ESPERA_ESTABILIDADE if espera is None else espera
+    tamanho_lote = tamanho_lote or TAMANHO_LOTE
+    registro = abrir_registro(ARQUIVO_REGISTRO) if USAR_REGISTRO else None
+    cache = abrir_cache(DIRETORIO_CACHE) if USAR_CACHE_LOCAL else None
+    concluidos = carregar_registro(registro) if registro is not None else {}
+    hashes = carregar_hashes(registro) if registro is not None else ({}, {})
+    planilha = None
+    mtimes_diretorios = {}
+    aguardando = {}  # caminho -> ((tamanho, mtime), visto desde)
+    exportacao_pendente = False
+    ultima_exportacao = time.time()
+    print(f"Observando {len(diretorios)} diretório(s) a cada {intervalo}s. Ctrl+C para parar.")
+
+    def carregar_planilha():
+        # A assinatura é tomada antes da leitura: uma gravação de outra execução durante a leitura
+        # muda a assinatura e força a releitura na próxima gravação
+        nonlocal planilha
+        if planilha is None:
+            assinatura = assinatura_planilha(os.path.join(DIRETORIO_DESTINO, ARQUIVO_DESTINO))
+            planilha = {"assinatura": assinatura, "numeros": carregar_numeros_existentes()}
+        return planilha
+
+    try:
+        for ciclo in itertools.count(1):
+            agora = time.time()
+            a_listar = []
+            for diretorio in diretorios:
+                try:
+                    mtime_diretorio = os.stat(diretorio).st_mtime
+                except Exception as e:
+                    print(f"Erro ao acessar o diretório {diretorio}: {e}")
+                    continue
+                pendentes = any(os.path.dirname(caminho) == diretorio for caminho in aguardando)
+                if mtimes_diretorios.get(diretorio) != mtime_diretorio or pendentes:
+                    mtimes_diretorios[diretorio] = mtime_diretorio
+                    a_listar.append(diretorio)
+            listados = descobrir_arquivos(a_listar) if a_listar else []
+            presentes = {arquivo.caminho for arquivo in listados}
+            for caminho in [caminho for caminho in aguardando
+                            if os.path.dirname(caminho) in a_listar and caminho not in presentes]:
+                del aguardando[caminho]
+            prontos = []
+            for arquivo in listados:
+                if arquivo_registrado(concluidos, arquivo):
+                    continue
+                assinatura = (arquivo.tamanho, arquivo.mtime)
+                anterior = aguardando.get(arquivo.caminho)
+                if anterior is None or anterior[0] != assinatura:
+                    aguardando[arquivo.caminho] = (assinatura, agora)
+                elif agora - anterior[1] >= espera:
+                    prontos.append(arquivo)
+            lotes = [prontos[inicio_lote:inicio_lote + tamanho_lote] for inicio_lote in range(0, len(prontos), tamanho_lote)]
+            if not lotes and os.path.exists(DIARIO_EXTRACAO):
+                lotes = [[]]  # Só o diário deixado por uma gravação que falhou (ou pela execução anterior)
+            for lote in lotes:
+                inicio = time.perf_counter()
+                numeros = carregar_planilha()["numeros"]
+                diario, retomados = preparar_diario()
+                resultado = processar_arquivos(lote, *numeros, registro, cache, hashes, diario=diario,
+                                               retomados=retomados, planilha=planilha)
+                encerrar_diario(diario, resultado.salvo)
+                if resultado.salvo:
+                    # Arquivos com erro também saem da fila (voltam ao reiniciar o modo); os incompletos
+                    # continuam aguardando
+                    incompletos = {arquivo.caminho for arquivo in resultado.incompletos}
+                    for arquivo in [arquivo for arquivo in lote if arquivo.caminho not in incompletos] + \
+                            [entrada[0] for entrada, _, _ in retomados]:
+                        concluidos[arquivo.caminho] = (arquivo.tamanho, arquivo.mtime)
+                        aguardando.pop(arquivo.caminho, None)
+                print(f"Lote de {len(lote)} arquivo(s): {resultado.extraidos} extraídos, {resultado.linhas} linhas "
+                      f"em {time.perf_counter() - inicio:.2f}s ({datetime.now().strftime('%d/%m/%Y %H:%M:%S')})")
+                exportacao_pendente = exportacao_pendente or (resultado.salvo and resultado.linhas > 0)
+            # Com o banco como registro oficial, a planilha é regenerada no máximo a cada INTERVALO_EXPORTACAO
+            if BACKEND_ARMAZENAMENTO == "sqlite" and exportacao_pendente \
+                    and time.time() - ultima_exportacao >= INTERVALO_EXPORTACAO:
+                exportar_planilha(BANCO_DADOS, DIRETORIO_DESTINO, ARQUIVO_DESTINO)
+                exportacao_pendente = False
+                ultima_exportacao = time.time()
+            if ciclos is not None and ciclo >= ciclos:
+                break
+            time.sleep(intervalo)
+    except KeyboardInterrupt:
+        print("Observação interrompida.")
+        if BACKEND_ARMAZENAMENTO == "sqlite" and exportacao_pendente:
+            exportar_planilha(BANCO_DADOS, DIRETORIO_DESTINO, ARQUIVO_DESTINO)
+    finally:
+        if registro is not None:
+            registro.close()
+        if cache is not None:
+            cache.conexao.close()
+
+def executar_script():
+    inicio = time.time()
+    if ORQUESTRACAO_ASYNC:
+        descricao.set("Processando arquivos CSV...")
+        root.update()
+
+        def arquivo_concluido(arquivos_lidos, total_arquivos):
+            atualizar_barra_progresso(progress, 2, total_passos, descricao, log, arquivos_lidos, total_arquivos, inicio)
+
+        metricas = asyncio.run(executar_pipeline_async(DIRETORIOS_ORIGEM, arquivo_concluido))
+        imprimir_metricas_pipeline(metricas)
+        print(f"Tempo total de execução: {time.time() - inicio:.2f} segundos")
+        descricao.set("Concluído!")
         root.update()
-        salvar_em_excel(sales_orders_data, quotations_data, DIRETORIO_DESTINO, ARQUIVO_DESTINO)
-        atualizar_barra_progresso(progress, 3, total_passos, descricao, log, arquivos_lidos, len(arquivos_csv), inicio)
+        return
+    descricao.set("Listando arquivos...")
+    root.update()
+    registro = abrir_registro(ARQUIVO_REGISTRO) if USAR_REGISTRO else None
+    varredura = None
+    cache = abrir_cache(DIRETORIO_CACHE) if USAR_CACHE_LOCAL or MODO_OFFLINE else None
+    if MODO_OFFLINE:
+        # Sem acesso à rede: a listagem vem do índice do cache e o retrato não é atualizado
+        arquivos_csv = arquivos_em_cache(cache, DIRETORIOS_ORIGEM)
+        print(f"Modo offline: {len(arquivos_csv)} arquivos no cache local")
+    elif USAR_SNAPSHOT:
+        conexao_snapshot = registro if registro is not None else abrir_registro(ARQUIVO_REGISTRO)
+        varredura = descobrir_com_snapshot(conexao_snapshot, DIRETORIOS_ORIGEM, completo=VARREDURA_COMPLETA)
+        diferenca = varredura.diferenca
+        print(f"Diretórios relistados: {len(varredura.listagens)} de {len(DIRETORIOS_ORIGEM)} - "
+              f"novos: {len(diferenca.novos)}, alterados: {len(diferenca.alterados)}, removidos: {len(diferenca.removidos)}")
+        # Com o registro, os arquivos do retrato ainda não concluídos (ex.: com erro) também voltam para a fila
+        arquivos_csv = varredura.arquivos if registro is not None else diferenca.novos + diferenca.alterados
     else:
-        print("Nenhum arquivo CSV encontrado nos diretórios de origem.")
+        arquivos_csv = descobrir_arquivos(DIRETORIOS_ORIGEM)
+
+    # Descartar pelo registro local os arquivos já concluídos, sem abri-los
+    if registro is not None:
+        concluidos = carregar_registro(registro)
+        total_listados = len(arquivos_csv)
+        arquivos_csv = [arquivo for arquivo in arquivos_csv if not arquivo_registrado(concluidos, arquivo)]
+        print(f"Arquivos já registrados: {total_listados - len(arquivos_csv)} de {total_listados}")
+    diario, retomados = preparar_diario()
+    atualizar_barra_progresso(progress, 1, total_passos, descricao, log, 0, len(arquivos_csv), inicio)
+
+    # Carregar números já existentes do Excel (ou do banco)
+    if arquivos_csv or retomados:
+        sales_numbers, quotations_numbers = carregar_numeros_existentes()
+    else:
+        sales_numbers, quotations_numbers = (set(), set())
+
+    descricao.set("Processando arquivos CSV...")
+    root.update()
+
+    def arquivo_concluido(arquivos_lidos, total_arquivos):
+        atualizar_barra_progresso(progress, 2, total_passos, descricao, log, arquivos_lidos, total_arquivos, inicio)
+
+    def ao_salvar():
+        descricao.set("Salvando em Excel...")
+        root.update()
+
+    resultado = processar_arquivos(arquivos_csv, sales_numbers, quotations_numbers, registro, cache,
+                                   ao_concluir_arquivo=arquivo_concluido, ao_salvar=ao_salvar,
+                                   diario=diario, retomados=retomados)
+    encerrar_diario(diario, resultado.salvo)
+    if resultado.extraidos:
+        atualizar_barra_progresso(progress, 3, total_passos, descricao, log, resultado.extraidos, resultado.extraidos, inicio)
+    salvo = resultado.salvo
+    if varredura is not None:
+        # O retrato só avança se a planilha foi salva; senão a próxima execução vê a mesma diferença
+        if salvo:
+            salvar_snapshot(conexao_snapshot, varredura.listagens)
+        if conexao_snapshot is not registro:
+            conexao_snapshot.close()
+    if registro is not None:
+        registro.close()
+    if cache is not None:
+        cache.conexao.close()
     fim = time.time()
     tempo_total = fim - inicio
     print(f"Tempo total de execução: {tempo_total:.2f} segundos")
     descricao.set("Concluído!")
     root.update()
 
+def ler_argumentos():
+    parser = argparse.ArgumentParser(description="Atualiza a planilha de Sales Orders/Quotations a partir dos CSV de BoQ.")
+    parser.add_argument("--observar", action="store_true",
+                        help="modo contínuo, sem janela: processa novos uploads em lotes (Ctrl+C para parar)")
+    parser.add_argument("--intervalo", type=float, default=INTERVALO_OBSERVACAO,
+                        help="segundos entre varreduras no modo --observar")
+    parser.add_argument("--retomar", action="store_true",
+                        help="aproveita o diário de uma execução interrompida em vez de extrair tudo de novo")
+    parser.add_argument("--exportar", action="store_true",
+                        help="regenera a planilha a partir do banco SQLite (BANCO_DADOS) e sai")
+    parser.add_argument("--reconstruir", action="store_true",
+                        help="refaz a planilha do zero a partir de todos os CSV de origem (ex.: após mudar o esquema) e sai")
+    return parser.parse_args()
+
 if __name__ == "__main__":
+    argumentos = ler_argumentos()
+    RETOMAR_EXECUCAO = RETOMAR_EXECUCAO or argumentos.retomar
+    if argumentos.reconstruir:
+        reconstruir_planilha(DIRETORIOS_ORIGEM, DIRETORIO_DESTINO, ARQUIVO_DESTINO)
+        raise SystemExit
+    if argumentos.exportar:
+        exportar_planilha(BANCO_DADOS, DIRETORIO_DESTINO, ARQUIVO_DESTINO)
+        raise SystemExit
+    if argumentos.observar:
+        observar_diretorios(DIRETORIOS_ORIGEM, intervalo=argumentos.intervalo)
+        raise SystemExit
     root = tk.Tk()
     root.title("Progresso do Script")
     root.geometry("400x150")
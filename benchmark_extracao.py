@@ -0,0 +1,62 @@
+import random
+import time
+
+import pandas as pd
+
+from atualizacao_r7 import CHAVES_ATRIBUTOS, MODOS_EXTRACAO
+
+# Compara os caminhos de extração de extrair_dados em arquivos sintéticos no formato dos BoQ
+TAMANHOS = [100, 500, 2000]  # Quantidade de módulos ('AT-') por arquivo
+LARGURA = 10
+REPETICOES = 3
+LIMITE_LINEAR = 100  # Acima disso o caminho linear (quadrático) leva minutos
+
+def gerar_boq(n_modulos, semente=0):
+    """
+    Gera um DataFrame no formato lido por processar_csv, com n_modulos linhas 'AT-'
+    seguidas das linhas de atributos de cada módulo.
+    """
+    aleatorio = random.Random(semente)
+    chaves = list(CHAVES_ATRIBUTOS)
+    linhas = [["5753532" + "00"] + [None] * (LARGURA - 1)]
+    for _ in range(n_modulos):
+        linha = [None] * LARGURA
+        linha[2] = aleatorio.choice(["AT-RM8310-E2", "AT-RM8320-E2", "AT-RM8711-E3"])
+        linha[3] = "1"
+        linha[8] = "21.05.2025"
+        linhas.append(linha)
+        for chave in aleatorio.sample(chaves, aleatorio.randint(len(chaves) // 2, len(chaves))):
+            linha = [None] * LARGURA
+            coluna = aleatorio.randint(1, LARGURA - 2)
+            linha[coluna] = chave
+            linha[coluna + 1] = aleatorio.choice(["90", "620", "Alu", "2160", None])
+            linhas.append(linha)
+    return pd.DataFrame(linhas)
+
+def medir(extrator, df):
+    melhor = None
+    for _ in range(REPETICOES):
+        inicio = time.perf_counter()
+        dados = extrator(df, "Sales Orders", "5753532", "01/01/2025", "cliente")
+        duracao = time.perf_counter() - inicio
+        melhor = duracao if melhor is None else min(melhor, duracao)
+    return melhor, dados
+
+if __name__ == "__main__":
+    for n_modulos in TAMANHOS:
+        df = gerar_boq(n_modulos)
+        print(f"{n_modulos} módulos, {len(df)} linhas")
+        referencia = None
+        tempos = {}
+        for modo, extrator in MODOS_EXTRACAO.items():
+            if modo == "linear" and n_modulos > LIMITE_LINEAR:
+                print(f"  {modo:>10}: ignorado (quadrático)")
+                continue
+            tempos[modo], dados = medir(extrator, df)
+            if referencia is None:
+                referencia = dados
+            iguais = "ok" if dados == referencia else "DIFERENTE"
+            print(f"  {modo:>10}: {tempos[modo]:.3f}s ({iguais})")
+        nome_base = "linear" if "linear" in tempos else "blocos"
+        for modo, duracao in tempos.items():
+            print(f"  {modo:>10}: {tempos[nome_base] / duracao:.1f}x em relação a {nome_base}")